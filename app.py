@@ -1,50 +1,34 @@
-import os, sqlite3, requests, telebot, datetime, mimetypes, cv2, html
-from flask import Flask, request, render_template, jsonify, send_from_directory
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+import os, sqlite3, datetime, mimetypes, html
+import click
+from flask import Flask, request, render_template, jsonify, send_from_directory, g, before_render_template, template_rendered
+from markupsafe import Markup, escape
+from werkzeug.security import safe_join
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import re
+import sys
+import shutil
+import struct
+import fcntl
+import subprocess
+import json
+import base64
 import time
+import hashlib
+import importlib.util
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 
 # 环境与类型配置
 mimetypes.add_type('video/mp4', '.mp4')
 mimetypes.add_type('video/quicktime', '.mov')
 app = Flask(__name__)
 
-# 简单的内存速率限制器
-rate_limit_storage = defaultdict(lambda: {'count': 0, 'reset_time': time.time()})
-
-def check_rate_limit(identifier, max_requests=10, window_seconds=60):
-    """简单的速率限制检查
-    
-    注意：此实现使用共享的 defaultdict 且不是线程安全的。
-    在生产环境中，建议使用 Redis 或其他线程安全的存储方案。
-    
-    Args:
-        identifier: 用户标识符 (如 user_id 或 IP)
-        max_requests: 时间窗口内最大请求数
-        window_seconds: 时间窗口（秒）
-    
-    Returns:
-        bool: True 表示允许请求，False 表示超过限制
-    """
-    current_time = time.time()
-    limit_data = rate_limit_storage[identifier]
-    
-    # 如果时间窗口已过，重置计数
-    if current_time > limit_data['reset_time']:
-        limit_data['count'] = 0
-        limit_data['reset_time'] = current_time + window_seconds
-    
-    # 检查是否超过限制
-    if limit_data['count'] >= max_requests:
-        return False
-    
-    # 增加计数
-    limit_data['count'] += 1
-    return True
-
 # 路径配置 (适配 Railway Volume)
-DB_DIR = '/app/data' if os.path.exists('/app/data') else 'data'
+DB_DIR = '/app/data' if os.path.exists('/app/data') else os.path.abspath('data')
 UPLOAD_DIR = os.path.join(DB_DIR, 'uploads')
 DB_PATH = os.path.join(DB_DIR, 'data.db')
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -59,96 +43,952 @@ ADMIN_KEY = os.environ.get("ADMIN_KEY", "matrix_admin_2024")
 if ADMIN_KEY == "matrix_admin_2024":
     print("WARNING: Using default ADMIN_KEY. Please set ADMIN_KEY environment variable for production!")
 
-bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+class LazyBot:
+    """TeleBot 的延迟代理：第一次访问 bot.* 时才导入 telebot（连同 requests）并创建实例，
+    worker 启动时不承担这部分导入开销"""
+    
+    def __init__(self, token):
+        self._token = token
+        self._bot = None
+        self._lock = threading.Lock()
+    
+    def __getattr__(self, name):
+        if self._bot is None:
+            with self._lock:
+                if self._bot is None:
+                    self._bot = load_telebot().TeleBot(self._token, threaded=False)
+        return getattr(self._bot, name)
+
+bot = LazyBot(BOT_TOKEN)
+
+# --- 性能指标 ---
+# 进程内的直方图 / 计数器，/metrics 以 Prometheus 文本格式输出（每个 gunicorn worker 各自统计，
+# 抓取时按 instance 区分或使用 --workers 1）。覆盖 HTTP 请求、Jinja 渲染、SQL 语句、Telegram API、
+# 媒体下载与 cv2 处理。
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRIC_HELP = {
+    'http_request_duration_seconds': 'HTTP 请求耗时',
+    'template_render_seconds': 'Jinja 模板渲染耗时',
+    'sql_statement_seconds': 'SQL 语句执行耗时（execute / executemany / commit）',
+    'telegram_api_seconds': 'Telegram Bot API 调用耗时',
+    'telegram_api_errors_total': 'Telegram Bot API 调用失败次数',
+    'media_download_seconds': 'download_media() 耗时（含 getFile、下载与封面）',
+    'media_download_bytes_total': '下载的媒体字节数',
+    'video_thumbnail_seconds': '视频封面生成耗时',
+    'derivative_seconds': '响应式派生图生成耗时',
+    'video_faststart_seconds': '视频 moov 前置耗时',
+    'video_hls_seconds': '视频 HLS 切片耗时',
+    'telegram_delivery_seconds': '发送队列中的消息从入队到送达的耗时',
+    'outbox_throttled_total': '因速率限制推迟发送的次数',
+    'outbox_retry_after_total': 'Telegram 返回 429 retry_after 的次数',
+}
+
+class Metrics:
+    """线程安全的直方图与计数器集合，标签组合作为序列的键"""
+    
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = defaultdict(float)
+        self.lock = threading.Lock()
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+    
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+    
+    def render(self):
+        """Prometheus 文本格式（text/plain; version=0.0.4）"""
+        def fmt_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            escape_value = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return '{' + ','.join(f'{k}="{escape_value(v)}"' for k, v in items) + '}'
+        
+        with self.lock:
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self.histograms.items()}
+            counters = dict(self.counters)
+        lines, declared = [], set()
+        for (name, labels), (counts, total, n) in sorted(histograms.items()):
+            if name not in declared:
+                lines += [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} histogram"]
+                declared.add(name)
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {n}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {n}")
+        for (name, labels), value in sorted(counters.items()):
+            if name not in declared:
+                lines += [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} counter"]
+                declared.add(name)
+            lines.append(f"{name}{fmt_labels(labels)} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+@contextmanager
+def timed(name, **labels):
+    """记录代码块耗时到直方图 name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.perf_counter() - start, **labels)
+
+def instrumented(name):
+    """装饰器：记录函数每次调用的耗时"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@lru_cache(maxsize=2048)
+def sql_label(sql):
+    """把 SQL 归一化为指标标签：合并空白，IN (?,?,...) 折叠为 IN (?...)，过长截断"""
+    label = re.sub(r'\s+', ' ', sql).strip()
+    label = re.sub(r'\(\?(?:\s*,\s*\?)+\)', '(?...)', label)
+    return label[:160]
+
+def instrument_telebot(apihelper):
+    """所有 bot.* 调用最终都经过 apihelper._make_request，包装它记录耗时与错误数"""
+    make_request = apihelper._make_request
+    
+    def timed_make_request(token, method_name, *args, **kwargs):
+        try:
+            with timed('telegram_api_seconds', method=method_name):
+                return make_request(token, method_name, *args, **kwargs)
+        except Exception:
+            metrics.inc('telegram_api_errors_total', method=method_name)
+            raise
+    
+    apihelper._make_request = timed_make_request
+
+# 慢请求采样分析（PROFILE_SLOW_MS > 0 时启用）：后台线程每 PROFILE_INTERVAL_MS 采样一次正在处理请求的线程栈，
+# 请求耗时超过阈值时把栈写入 PROFILE_DIR/<时间>-<路由>.folded（collapsed 格式，可直接交给 flamegraph.pl / speedscope）
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 0))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL_MS", 5)) / 1000
+PROFILE_DIR = os.path.join(DB_DIR, 'profiles')
+PROFILE_KEEP = 100
+
+_profiled_threads = {}  # 线程 ID -> 该请求的栈采样计数
+_profile_lock = threading.Lock()
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def profile_sampler():
+    """后台线程：采样所有正在处理请求的线程"""
+    while True:
+        time.sleep(PROFILE_INTERVAL)
+        with _profile_lock:
+            if not _profiled_threads:
+                continue
+            frames = sys._current_frames()
+            for tid, samples in _profiled_threads.items():
+                frame = frames.get(tid)
+                if frame is not None:
+                    samples[collapse_stack(frame)] += 1
+
+def save_profile(route, duration, samples):
+    """写出一次慢请求的 collapsed 栈，只保留最近 PROFILE_KEEP 个文件"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r'[^\w]+', '_', route).strip('_') or 'root'
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{slug}-{int(duration * 1000)}ms.folded"
+    with open(os.path.join(PROFILE_DIR, name), 'w') as f:
+        f.writelines(f"{stack} {count}\n" for stack, count in samples.items())
+    profiles = sorted(os.listdir(PROFILE_DIR))
+    for old in profiles[:-PROFILE_KEEP]:
+        try: os.remove(os.path.join(PROFILE_DIR, old))
+        except OSError: pass
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if PROFILE_SLOW_MS > 0:
+        with _profile_lock:
+            _profiled_threads[threading.get_ident()] = defaultdict(int)
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    duration = time.perf_counter() - g.get('request_started', time.perf_counter())
+    metrics.observe('http_request_duration_seconds', duration, route=route, method=request.method, status=response.status_code)
+    if PROFILE_SLOW_MS > 0:
+        with _profile_lock:
+            samples = _profiled_threads.pop(threading.get_ident(), None)
+        if samples and duration * 1000 >= PROFILE_SLOW_MS:
+            try:
+                save_profile(route, duration, samples)
+            except OSError as e:
+                print(f"Profile write error: {e}")
+    return response
+
+@app.teardown_request
+def discard_request_profile(exc):
+    # 请求异常结束时 after_request 不会执行，这里清理采样记录
+    if PROFILE_SLOW_MS > 0:
+        with _profile_lock:
+            _profiled_threads.pop(threading.get_ident(), None)
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('template_started', {})[template.name] = time.perf_counter()
+
+def _template_finished(sender, template, context, **extra):
+    started = g.get('template_started', {}).pop(template.name, None)
+    if started is not None:
+        metrics.observe('template_render_seconds', time.perf_counter() - started, template=template.name)
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_finished, app)
 
 # --- 数据库管理 ---
-def get_db():
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row
+# 每个线程复用一个连接（gunicorn fork 后按 pid 重建），连接建立时统一设置 WAL 等参数。
+# SQLite 自身只忙等待一小段时间，之后由 Python 重试，从而统计出等待写锁的耗时。
+DB_BUSY_TIMEOUT = 30      # 等待写锁的总时长（秒）
+DB_BUSY_SLICE = 0.05      # 每次交给 SQLite busy handler 的等待时长（秒）
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+db_stats = {'connections': 0, 'busy_waits': 0, 'busy_wait_seconds': 0.0, 'busy_timeouts': 0}
+_db_stats_lock = threading.Lock()
+_db_local = threading.local()
+
+class PooledConnection(sqlite3.Connection):
+    """线程内复用的连接，遇到 database is locked 时重试并记录等待时间"""
+    
+    def _retry_busy(self, fn, *args):
+        started = None
+        while True:
+            try:
+                result = fn(*args)
+                break
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                now = time.monotonic()
+                if started is None:
+                    started = now - DB_BUSY_SLICE
+                if now - started >= DB_BUSY_TIMEOUT:
+                    with _db_stats_lock:
+                        db_stats['busy_timeouts'] += 1
+                        db_stats['busy_wait_seconds'] += now - started
+                    raise
+        if started is not None:
+            with _db_stats_lock:
+                db_stats['busy_waits'] += 1
+                db_stats['busy_wait_seconds'] += time.monotonic() - started
+        return result
+    
+    def execute(self, sql, parameters=()):
+        with timed('sql_statement_seconds', statement=sql_label(sql)):
+            return self._retry_busy(super().execute, sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        with timed('sql_statement_seconds', statement=sql_label(sql)):
+            return self._retry_busy(super().executemany, sql, seq_of_parameters)
+    
+    def commit(self):
+        with timed('sql_statement_seconds', statement='COMMIT'):
+            return self._retry_busy(super().commit)
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 与 sqlite3.Connection 相同：正常退出提交，异常回滚；连接本身不关闭，留给线程复用
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+def get_db(path=None):
+    """获取当前线程复用的数据库连接
+    
+    Args:
+        path: 数据库文件路径，默认主库 DB_PATH
+    """
+    path = path or DB_PATH
+    if getattr(_db_local, 'pid', None) != os.getpid():
+        _db_local.conns, _db_local.pid = {}, os.getpid()
+    conn = _db_local.conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=DB_BUSY_SLICE, factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        _db_local.conns[path] = conn
+        with _db_stats_lock:
+            db_stats['connections'] += 1
     return conn
 
-def init_db():
-    with get_db() as conn:
-        # 创建核心表
-        conn.executescript('''
-            CREATE TABLE IF NOT EXISTS posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                msg_id INTEGER UNIQUE, 
-                text TEXT, 
-                title TEXT, 
-                date TEXT, 
-                likes INTEGER DEFAULT 0, 
-                media_group_id TEXT, 
-                first_media TEXT, 
-                is_approved INTEGER DEFAULT 1, 
-                user_id INTEGER,
-                blacklist_count INTEGER DEFAULT 0,
-                custom_description TEXT
-            );
-            CREATE TABLE IF NOT EXISTS blacklist (user_id INTEGER PRIMARY KEY, date TEXT);
-            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
-            CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY AUTOINCREMENT, post_id INTEGER, content TEXT, date TEXT, user_id TEXT);
-            CREATE TABLE IF NOT EXISTS user_blacklist (user_id TEXT, post_id INTEGER, date TEXT, PRIMARY KEY (user_id, post_id));
-            CREATE TABLE IF NOT EXISTS user_favorites (
-                user_id TEXT, 
-                post_id INTEGER, 
-                date TEXT, 
-                PRIMARY KEY (user_id, post_id)
+# --- 数据库迁移 ---
+# 表结构版本记录在 PRAGMA user_version 中。启动时只读一次版本号，已是最新就直接返回；
+# 否则在 <数据库文件>.migrate.lock 文件锁内执行尚未执行的迁移，多个 gunicorn worker 同时启动时
+# 只有一个真正执行，其余等锁释放后重新读到最新版本直接跳过。
+# 每个迁移连同版本号更新在同一个 BEGIN IMMEDIATE 事务中执行，中途失败整体回滚，下次启动重新执行。
+# 迁移内的多条语句请用 execute_script 而不是 conn.executescript（后者会先提交当前事务）。
+# 1~4 号迁移是引入版本号之前每次启动都会执行的建表 / 补字段 / 回填逻辑，全部幂等，可以直接在旧库上执行；
+# 新的表结构变更请在 MIGRATIONS 末尾追加，不要修改已发布的迁移。
+
+def execute_script(conn, script):
+    """在当前事务中逐条执行多条 SQL 语句"""
+    *parts, statement = script.split(';')
+    pending = ''
+    for part in parts:
+        # 字符串或触发器体内的分号不结束语句，拼到下一段继续判断
+        pending += part + ';'
+        if sqlite3.complete_statement(pending):
+            conn.execute(pending)
+            pending = ''
+    if (pending + statement).strip():
+        conn.execute(pending + statement)
+
+def run_migrations(path, migrations):
+    """执行数据库中尚未执行的迁移
+    
+    Args:
+        path: 数据库文件路径
+        migrations: [(版本号, 迁移函数), ...]，按版本号升序，迁移函数接收数据库连接
+    
+    Returns:
+        int: 执行后的版本号
+    """
+    conn = get_db(path)
+    target = migrations[-1][0]
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+        return target
+    with open(path + '.migrate.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, migrate in migrations:
+                if number <= version:
+                    continue
+                started = time.perf_counter()
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    migrate(conn)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                print(f"Migrated {os.path.basename(path)} to version {number} ({migrate.__name__}, {time.perf_counter() - started:.2f}s)")
+            return max(version, target)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def migrate_core_tables(conn):
+    # 创建核心表
+    execute_script(conn, '''
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            msg_id INTEGER UNIQUE, 
+            text TEXT, 
+            title TEXT, 
+            date TEXT, 
+            likes INTEGER DEFAULT 0, 
+            media_group_id TEXT, 
+            first_media TEXT, 
+            is_approved INTEGER DEFAULT 1, 
+            user_id INTEGER,
+            blacklist_count INTEGER DEFAULT 0,
+            custom_description TEXT,
+            comment_count INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS blacklist (user_id INTEGER PRIMARY KEY, date TEXT);
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY AUTOINCREMENT, post_id INTEGER, content TEXT, date TEXT, user_id TEXT);
+        CREATE TABLE IF NOT EXISTS user_blacklist (user_id TEXT, post_id INTEGER, date TEXT, PRIMARY KEY (user_id, post_id));
+        CREATE TABLE IF NOT EXISTS user_favorites (
+            user_id TEXT, 
+            post_id INTEGER, 
+            date TEXT, 
+            PRIMARY KEY (user_id, post_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_posts_approved ON posts(is_approved);
+        CREATE INDEX IF NOT EXISTS idx_posts_date ON posts(date DESC);
+        CREATE INDEX IF NOT EXISTS idx_comments_post ON comments(post_id);
+        CREATE INDEX IF NOT EXISTS idx_favorites_user ON user_favorites(user_id);
+        CREATE TABLE IF NOT EXISTS ingest_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL,
+            updated_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_ingest_status ON ingest_queue(status, next_attempt_at);
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            method TEXT NOT NULL,
+            chat_id TEXT,
+            params TEXT NOT NULL,
+            coalesce_key TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL,
+            updated_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, next_attempt_at);
+        CREATE INDEX IF NOT EXISTS idx_outbox_coalesce ON outbox(coalesce_key, status);
+        CREATE TABLE IF NOT EXISTS cache_events (id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT, created_at REAL);
+        INSERT OR IGNORE INTO settings (key, value) VALUES ('notice', '欢迎访问 Matrix Hub');
+    ''')
+
+    # 补齐旧数据库缺少的字段
+    cursor = conn.execute("PRAGMA table_info(posts)")
+    columns = [c[1] for c in cursor.fetchall()]
+    if 'user_id' not in columns:
+        try: conn.execute("ALTER TABLE posts ADD COLUMN user_id INTEGER")
+        except: pass
+    if 'is_approved' not in columns:
+        try: conn.execute("ALTER TABLE posts ADD COLUMN is_approved INTEGER DEFAULT 1")
+        except: pass
+    if 'blacklist_count' not in columns:
+        try: conn.execute("ALTER TABLE posts ADD COLUMN blacklist_count INTEGER DEFAULT 0")
+        except: pass
+    if 'custom_description' not in columns:
+        try: conn.execute("ALTER TABLE posts ADD COLUMN custom_description TEXT")
+        except: pass
+    if 'thumbnail' not in columns:
+        try: conn.execute("ALTER TABLE posts ADD COLUMN thumbnail TEXT")
+        except: pass
+    if 'comment_count' not in columns:
+        # 评论数冗余存储在 posts 上，由 comment() / admin_delete_comment() 随增删维护，首次迁移时回填
+        try:
+            conn.execute("ALTER TABLE posts ADD COLUMN comment_count INTEGER DEFAULT 0")
+            conn.execute("UPDATE posts SET comment_count = (SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id)")
+        except: pass
+
+    # 迁移 comments 表的 user_id 字段
+    cursor = conn.execute("PRAGMA table_info(comments)")
+    comment_columns = [c[1] for c in cursor.fetchall()]
+    if 'user_id' not in comment_columns:
+        try: conn.execute("ALTER TABLE comments ADD COLUMN user_id TEXT")
+        except: pass
+    # 个人页按 user_id 取最近评论；idx_comments_post 隐含 rowid，已覆盖按 post_id 的 id 倒序分页
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_user ON comments(user_id, id)")
+
+    # 入库队列的相册分组键（同一相册的任务一起领取）
+    cursor = conn.execute("PRAGMA table_info(ingest_queue)")
+    if 'group_key' not in [c[1] for c in cursor.fetchall()]:
+        try: conn.execute("ALTER TABLE ingest_queue ADD COLUMN group_key TEXT")
+        except: pass
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_group ON ingest_queue(group_key, status)")
+
+def migrate_feed(conn):
+    # 首页 feed：每个相册或单条帖子一行（相册取最早的一条作为代表），由 posts 上的触发器维护，
+    # 首页按 post_id 做游标分页；counters 表记录 feed 行数，分页总数不再需要 COUNT
+    execute_script(conn, '''
+        CREATE TABLE IF NOT EXISTS feed (post_id INTEGER PRIMARY KEY, group_key TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER DEFAULT 0);
+        CREATE INDEX IF NOT EXISTS idx_posts_group ON posts(media_group_id);
+        INSERT OR IGNORE INTO counters (name, value) VALUES ('feed', 0);
+        CREATE TRIGGER IF NOT EXISTS feed_count_ai AFTER INSERT ON feed BEGIN
+            UPDATE counters SET value=value+1 WHERE name='feed';
+        END;
+        CREATE TRIGGER IF NOT EXISTS feed_count_ad AFTER DELETE ON feed BEGIN
+            UPDATE counters SET value=value-1 WHERE name='feed';
+        END;
+        CREATE TRIGGER IF NOT EXISTS posts_feed_ai AFTER INSERT ON posts WHEN new.is_approved=1 BEGIN
+            INSERT OR IGNORE INTO feed (post_id, group_key) VALUES (new.id, COALESCE('G' || new.media_group_id, 'P' || new.id));
+        END;
+        CREATE TRIGGER IF NOT EXISTS posts_feed_au AFTER UPDATE OF is_approved, media_group_id ON posts BEGIN
+            DELETE FROM feed WHERE group_key IN (COALESCE('G' || old.media_group_id, 'P' || old.id), COALESCE('G' || new.media_group_id, 'P' || new.id));
+            INSERT INTO feed (post_id, group_key)
+                SELECT MIN(id), COALESCE('G' || old.media_group_id, 'P' || old.id) FROM posts
+                WHERE is_approved=1 AND (CASE WHEN old.media_group_id IS NULL THEN id=old.id ELSE media_group_id=old.media_group_id END)
+                HAVING MIN(id) IS NOT NULL;
+            INSERT OR IGNORE INTO feed (post_id, group_key)
+                SELECT MIN(id), COALESCE('G' || new.media_group_id, 'P' || new.id) FROM posts
+                WHERE is_approved=1 AND (CASE WHEN new.media_group_id IS NULL THEN id=new.id ELSE media_group_id=new.media_group_id END)
+                HAVING MIN(id) IS NOT NULL;
+        END;
+        CREATE TRIGGER IF NOT EXISTS posts_feed_ad AFTER DELETE ON posts BEGIN
+            DELETE FROM feed WHERE group_key = COALESCE('G' || old.media_group_id, 'P' || old.id);
+            INSERT INTO feed (post_id, group_key)
+                SELECT MIN(id), 'G' || old.media_group_id FROM posts
+                WHERE old.media_group_id IS NOT NULL AND media_group_id=old.media_group_id AND is_approved=1
+                HAVING MIN(id) IS NOT NULL;
+        END;
+    ''')
+    # 回填旧数据库已有的帖子（引入版本号之前已建 feed 的库中对应行已存在，INSERT OR IGNORE 跳过）
+    conn.execute("""INSERT OR IGNORE INTO feed (post_id, group_key)
+                    SELECT MIN(id), COALESCE('G' || media_group_id, 'P' || id) as k FROM posts
+                    WHERE is_approved=1 GROUP BY k""")
+    conn.execute("UPDATE counters SET value=(SELECT COUNT(*) FROM feed) WHERE name='feed'")
+
+def migrate_media_store(conn):
+    # 按内容哈希存储的媒体文件，refcount 为引用该文件的媒体条目数，由 post_media 上的触发器维护
+    execute_script(conn, '''
+        CREATE TABLE IF NOT EXISTS media (
+            hash TEXT PRIMARY KEY,
+            path TEXT UNIQUE,
+            size INTEGER,
+            refcount INTEGER DEFAULT 0,
+            touched_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_media_refcount ON media(refcount);
+        CREATE TABLE IF NOT EXISTS media_aliases (
+            file_unique_id TEXT PRIMARY KEY,
+            hash TEXT NOT NULL
+        );
+    ''')
+
+    # 相册在入库时合并为一条帖子，各条媒体按 position 存放在 post_media 中；
+    # posts.first_media / thumbnail 保留第一条媒体，首页与收藏页无需再按相册分组。
+    # media.refcount 统计引用该文件的 post_media 行数
+    execute_script(conn, '''
+        DROP TRIGGER IF EXISTS posts_media_ai;
+        DROP TRIGGER IF EXISTS posts_media_ad;
+        DROP TRIGGER IF EXISTS posts_media_au;
+        CREATE TABLE IF NOT EXISTS post_media (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            msg_id INTEGER UNIQUE,
+            media TEXT,
+            thumbnail TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_post_media_post ON post_media(post_id, position);
+        CREATE TRIGGER IF NOT EXISTS posts_post_media_ad AFTER DELETE ON posts BEGIN
+            DELETE FROM post_media WHERE post_id=old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS post_media_ai AFTER INSERT ON post_media BEGIN
+            UPDATE media SET refcount=refcount+1 WHERE path=new.media;
+        END;
+        CREATE TRIGGER IF NOT EXISTS post_media_ad AFTER DELETE ON post_media BEGIN
+            UPDATE media SET refcount=refcount-1 WHERE path=old.media;
+        END;
+        CREATE TRIGGER IF NOT EXISTS post_media_au AFTER UPDATE OF media ON post_media
+        WHEN old.media IS NOT new.media BEGIN
+            UPDATE media SET refcount=refcount-1 WHERE path=old.media;
+            UPDATE media SET refcount=refcount+1 WHERE path=new.media;
+        END;
+    ''')
+    # 旧数据库：每个相册保留 id 最小的一行，其余行的媒体、点赞、评论、收藏、拉黑合并过来后删除。
+    # 是否合并只由版本号决定（本迁移只执行一次）；引入版本号之前已合并过的库中每个相册只剩一行、
+    # 媒体已在 post_media 中，下面的语句不会修改任何数据，refcount 按 post_media 重新统计
+    execute_script(conn, '''
+        CREATE TEMP TABLE album_merge AS
+            SELECT id AS old_id, FIRST_VALUE(id) OVER w AS keeper_id, ROW_NUMBER() OVER w - 1 AS position
+            FROM posts WINDOW w AS (PARTITION BY COALESCE('G' || media_group_id, 'P' || id) ORDER BY id);
+        INSERT INTO post_media (post_id, position, msg_id, media, thumbnail)
+            SELECT m.keeper_id, m.position, p.msg_id, p.first_media, p.thumbnail
+            FROM album_merge m JOIN posts p ON p.id = m.old_id
+            WHERE p.first_media IS NOT NULL AND NOT EXISTS (SELECT 1 FROM post_media pm WHERE pm.msg_id = p.msg_id);
+        DELETE FROM album_merge WHERE old_id = keeper_id;
+        UPDATE posts SET
+            likes = likes + (SELECT COALESCE(SUM(p2.likes), 0) FROM album_merge m JOIN posts p2 ON p2.id = m.old_id WHERE m.keeper_id = posts.id),
+            text = COALESCE(NULLIF(text, ''), (SELECT p2.text FROM album_merge m JOIN posts p2 ON p2.id = m.old_id
+                                               WHERE m.keeper_id = posts.id AND p2.text <> '' ORDER BY p2.id LIMIT 1), text),
+            custom_description = COALESCE(custom_description, (SELECT p2.custom_description FROM album_merge m JOIN posts p2 ON p2.id = m.old_id
+                                                               WHERE m.keeper_id = posts.id AND p2.custom_description IS NOT NULL ORDER BY p2.id LIMIT 1))
+        WHERE id IN (SELECT keeper_id FROM album_merge);
+        UPDATE comments SET post_id = (SELECT keeper_id FROM album_merge WHERE old_id = comments.post_id)
+        WHERE post_id IN (SELECT old_id FROM album_merge);
+        INSERT OR IGNORE INTO user_favorites (user_id, post_id, date)
+            SELECT f.user_id, m.keeper_id, f.date FROM user_favorites f JOIN album_merge m ON m.old_id = f.post_id;
+        DELETE FROM user_favorites WHERE post_id IN (SELECT old_id FROM album_merge);
+        INSERT OR IGNORE INTO user_blacklist (user_id, post_id, date)
+            SELECT b.user_id, m.keeper_id, b.date FROM user_blacklist b JOIN album_merge m ON m.old_id = b.post_id;
+        DELETE FROM user_blacklist WHERE post_id IN (SELECT old_id FROM album_merge);
+        UPDATE posts SET blacklist_count = (SELECT COUNT(*) FROM user_blacklist WHERE post_id = posts.id),
+                         comment_count = (SELECT COUNT(*) FROM comments WHERE post_id = posts.id)
+        WHERE id IN (SELECT keeper_id FROM album_merge);
+        DELETE FROM posts WHERE id IN (SELECT old_id FROM album_merge);
+        DROP TABLE album_merge;
+        -- 相关子查询而不是 UPDATE ... FROM（需要 SQLite >= 3.33）；先按文件汇总到带主键的临时表，逐行查找走索引
+        CREATE TEMP TABLE media_refs (media TEXT PRIMARY KEY, n INTEGER);
+        INSERT INTO media_refs SELECT media, COUNT(*) FROM post_media WHERE media IS NOT NULL GROUP BY media;
+        UPDATE media SET refcount = COALESCE((SELECT n FROM media_refs WHERE media_refs.media = media.path), 0);
+        DROP TABLE media_refs;
+    ''')
+
+def migrate_fts(conn):
+    # 全文检索索引：external content 表 + 触发器同步，trigram 分词器可按子串匹配中文
+    # trigram 需要 SQLite >= 3.34，不可用时搜索退回 LIKE
+    try:
+        execute_script(conn, '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+                text, custom_description, content='posts', content_rowid='id', tokenize='trigram'
             );
-            CREATE INDEX IF NOT EXISTS idx_posts_approved ON posts(is_approved);
-            CREATE INDEX IF NOT EXISTS idx_posts_date ON posts(date DESC);
-            CREATE INDEX IF NOT EXISTS idx_comments_post ON comments(post_id);
-            CREATE INDEX IF NOT EXISTS idx_favorites_user ON user_favorites(user_id);
-            INSERT OR IGNORE INTO settings (key, value) VALUES ('notice', '欢迎访问 Matrix Hub');
+            CREATE TRIGGER IF NOT EXISTS posts_fts_ai AFTER INSERT ON posts BEGIN
+                INSERT INTO posts_fts (rowid, text, custom_description) VALUES (new.id, new.text, new.custom_description);
+            END;
+            CREATE TRIGGER IF NOT EXISTS posts_fts_ad AFTER DELETE ON posts BEGIN
+                INSERT INTO posts_fts (posts_fts, rowid, text, custom_description) VALUES ('delete', old.id, old.text, old.custom_description);
+            END;
+            CREATE TRIGGER IF NOT EXISTS posts_fts_au AFTER UPDATE OF text, custom_description ON posts BEGIN
+                INSERT INTO posts_fts (posts_fts, rowid, text, custom_description) VALUES ('delete', old.id, old.text, old.custom_description);
+                INSERT INTO posts_fts (rowid, text, custom_description) VALUES (new.id, new.text, new.custom_description);
+            END;
         ''')
-        
-        # 字段自动迁移逻辑 (安全处理旧数据库)
-        # 注意：这是简单的迁移方案，适合小型项目
-        # 生产环境建议使用 Alembic 等专业的数据库迁移工具
-        cursor = conn.execute("PRAGMA table_info(posts)")
-        columns = [c[1] for c in cursor.fetchall()]
-        if 'user_id' not in columns:
-            try: conn.execute("ALTER TABLE posts ADD COLUMN user_id INTEGER")
-            except: pass
-        if 'is_approved' not in columns:
-            try: conn.execute("ALTER TABLE posts ADD COLUMN is_approved INTEGER DEFAULT 1")
-            except: pass
-        if 'blacklist_count' not in columns:
-            try: conn.execute("ALTER TABLE posts ADD COLUMN blacklist_count INTEGER DEFAULT 0")
-            except: pass
-        if 'custom_description' not in columns:
-            try: conn.execute("ALTER TABLE posts ADD COLUMN custom_description TEXT")
-            except: pass
-        if 'thumbnail' not in columns:
-            try: conn.execute("ALTER TABLE posts ADD COLUMN thumbnail TEXT")
-            except: pass
-        
-        # 迁移 comments 表的 user_id 字段
-        cursor = conn.execute("PRAGMA table_info(comments)")
-        comment_columns = [c[1] for c in cursor.fetchall()]
-        if 'user_id' not in comment_columns:
-            try: conn.execute("ALTER TABLE comments ADD COLUMN user_id TEXT")
-            except: pass
+        # 按 posts 重建索引，回填旧数据库已有的帖子
+        conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 unavailable, falling back to LIKE search: {e}")
 
-init_db()
+# 热门排序参数（迁移回填与在线累加共用）。HOT_NEW_POST_SCORE 写在 feed_hot_ai 触发器中，修改后需追加迁移重建触发器
+HOT_WEIGHTS = {'like': 1.0, 'comment': 3.0, 'favorite': 5.0, 'blacklist': -5.0}
+HOT_NEW_POST_SCORE = 10.0
+HOT_HALF_LIFE = float(os.environ.get("HOT_HALF_LIFE_HOURS", 24)) * 3600
+HOT_BACKFILL_MAX_HALF_LIVES = 900  # 0.5 ** 900 仍是正常浮点数（下限约 2^-1022）
 
-# --- 媒体处理 ---
-def generate_video_thumbnail(video_path, thumbnail_path):
-    """使用 cv2 生成视频缩略图
+def migrate_hot_rank(conn):
+    # 热门排序：hot_rank 为每个进入过 feed 的帖子保存一个随时间衰减的热度分，按 (score, post_id) 倒序扫描索引即为热门页。
+    # 分数以 settings.hot_epoch 时刻为单位：事件发生时加上 权重 × hot_scale（= 2^((当前时间 - hot_epoch) / 半衰期)），
+    # 已有分数不随时间改写，相对大小与按事件时间逐一衰减求和一致。hot_scale 与定期的整体折算见「热门排序」一节
+    now = time.time()
+    # 回填已有帖子：没有逐条事件的时间，按发帖日期整体衰减。基准取最新一条帖子的日期，
+    # 衰减最多 HOT_BACKFILL_MAX_HALF_LIVES 个半衰期，再早的帖子按互动量排序，不会下溢成 0 而只剩 post_id 的顺序
+    # （之后的整体折算照常进行，长期没有任何互动的帖子仍会逐渐趋近 0）
+    rows = conn.execute("""SELECT p.id, p.date, p.likes, p.comment_count, p.blacklist_count,
+                                  (SELECT COUNT(*) FROM user_favorites WHERE post_id = p.id) AS favorites
+                           FROM feed f JOIN posts p ON p.id = f.post_id""").fetchall()
+    dates = {}
+    for r in rows:
+        try:
+            dates[r['id']] = min(datetime.strptime(r['date'], "%Y-%m-%d").timestamp(), now)
+        except (TypeError, ValueError):
+            pass
+    epoch = max(dates.values(), default=now)
+    scores = []
+    for r in rows:
+        half_lives = min((epoch - dates.get(r['id'], epoch)) / HOT_HALF_LIFE, HOT_BACKFILL_MAX_HALF_LIVES)
+        raw = (HOT_NEW_POST_SCORE + (r['likes'] or 0) * HOT_WEIGHTS['like'] + (r['comment_count'] or 0) * HOT_WEIGHTS['comment']
+               + r['favorites'] * HOT_WEIGHTS['favorite'] + (r['blacklist_count'] or 0) * HOT_WEIGHTS['blacklist'])
+        scores.append((r['id'], raw * 0.5 ** half_lives))
+    scale = 2 ** ((now - epoch) / HOT_HALF_LIFE)
+    execute_script(conn, f'''
+        CREATE TABLE IF NOT EXISTS hot_rank (post_id INTEGER PRIMARY KEY, score REAL NOT NULL DEFAULT 0);
+        CREATE INDEX IF NOT EXISTS idx_hot_rank_score ON hot_rank(score, post_id);
+        INSERT OR IGNORE INTO settings (key, value) VALUES ('hot_epoch', '{epoch!r}'), ('hot_scale', '{scale!r}');
+        -- 撤回审核时保留分数（读取时按 feed 过滤），重新通过后沿用
+        CREATE TRIGGER IF NOT EXISTS feed_hot_ai AFTER INSERT ON feed BEGIN
+            INSERT OR IGNORE INTO hot_rank (post_id, score)
+            VALUES (new.post_id, {HOT_NEW_POST_SCORE!r} * (SELECT CAST(value AS REAL) FROM settings WHERE key='hot_scale'));
+        END;
+        CREATE TRIGGER IF NOT EXISTS posts_hot_ad AFTER DELETE ON posts BEGIN
+            DELETE FROM hot_rank WHERE post_id=old.id;
+        END;
+    ''')
+    conn.executemany("INSERT OR IGNORE INTO hot_rank (post_id, score) VALUES (?, ?)", scores)
+
+def migrate_hls_queue(conn):
+    # HLS 切片队列：视频帖子入库的事务中登记，由后台线程在入库任务之外执行 ffmpeg
+    execute_script(conn, '''
+        CREATE TABLE IF NOT EXISTS hls_queue (
+            name TEXT PRIMARY KEY,
+            attempts INTEGER DEFAULT 0,
+            claimed_at REAL DEFAULT 0,
+            created_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_hls_queue_claimed ON hls_queue(claimed_at);
+    ''')
+
+MIGRATIONS = [
+    (1, migrate_core_tables),
+    (2, migrate_feed),
+    (3, migrate_media_store),
+    (4, migrate_fts),
+    (5, migrate_hot_rank),
+    (6, migrate_hls_queue),
+]
+
+run_migrations(DB_PATH, MIGRATIONS)
+with get_db() as conn:
+    # SQLite 不支持 trigram 时 migrate_fts 不会建表，搜索退回 LIKE
+    FTS_ENABLED = conn.execute("SELECT 1 FROM sqlite_master WHERE name='posts_fts'").fetchone() is not None
+
+def build_fts_query(q):
+    """把搜索词转换为 FTS5 MATCH 表达式
+    
+    每个空格分隔的词作为短语并以 AND 连接。trigram 分词器无法匹配少于 3 个字符的词，
+    此时返回 None，由调用方退回 LIKE 查询。
+    """
+    terms = q.split()
+    if not FTS_ENABLED or not terms or any(len(t) < 3 for t in terms):
+        return None
+    return ' '.join('"' + t.replace('"', '""') + '"' for t in terms)
+
+# --- 速率限制 ---
+# 令牌桶存放在独立的 SQLite 文件中，所有 gunicorn worker 共享，且不与主库争抢写锁。
+# 每次检查是一条原子 UPSERT：令牌按时间补充，不足 1 个时语句不修改任何行。
+RATE_LIMIT_DB_PATH = os.path.join(DB_DIR, 'ratelimit.db')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+RATE_LIMIT_SWEEP_INTERVAL = 60
+
+_rate_limit_last_sweep = 0
+
+def migrate_rate_limits(conn):
+    execute_script(conn, '''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens REAL,
+            updated_at REAL,
+            expires_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_rate_limits_expires ON rate_limits(expires_at);
+    ''')
+
+run_migrations(RATE_LIMIT_DB_PATH, [(1, migrate_rate_limits)])
+
+def sweep_rate_limits():
+    """清理空闲的 key：桶已补满（expires_at 已过）的记录可以直接删除，
+    超过 RATE_LIMIT_MAX_KEYS 时再按过期时间淘汰最旧的记录"""
+    global _rate_limit_last_sweep
+    now = time.time()
+    _rate_limit_last_sweep = now
+    with get_db(RATE_LIMIT_DB_PATH) as conn:
+        conn.execute("DELETE FROM rate_limits WHERE expires_at<?", (now,))
+        excess = conn.execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0] - RATE_LIMIT_MAX_KEYS
+        if excess > 0:
+            conn.execute("DELETE FROM rate_limits WHERE key IN (SELECT key FROM rate_limits ORDER BY expires_at LIMIT ?)", (excess,))
+
+def check_rate_limit(identifier, max_requests=10, window_seconds=60):
+    """跨进程共享的令牌桶速率限制
+    
+    桶容量为 max_requests，每 window_seconds 秒补满。数据库异常时放行请求。
     
     Args:
-        video_path: 视频文件路径
-        thumbnail_path: 缩略图保存路径
-        
+        identifier: 限制的 key（如 like_<user_id>）
+        max_requests: 时间窗口内最大请求数
+        window_seconds: 时间窗口（秒）
+    
     Returns:
-        bool: 成功返回True，失败返回False
+        bool: True 表示允许请求，False 表示超过限制
+    """
+    now = time.time()
+    rate = max_requests / window_seconds
+    try:
+        if now - _rate_limit_last_sweep > RATE_LIMIT_SWEEP_INTERVAL:
+            sweep_rate_limits()
+        with get_db(RATE_LIMIT_DB_PATH) as conn:
+            cursor = conn.execute("""
+                INSERT INTO rate_limits (key, tokens, updated_at, expires_at) VALUES (:key, :capacity - 1, :now, :now + :window)
+                ON CONFLICT(key) DO UPDATE SET
+                    tokens = MIN(:capacity, tokens + (:now - updated_at) * :rate) - 1,
+                    updated_at = :now,
+                    expires_at = :now + :window
+                WHERE MIN(:capacity, tokens + (:now - updated_at) * :rate) >= 1
+            """, {"key": identifier, "capacity": max_requests, "rate": rate, "now": now, "window": window_seconds})
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        print(f"Rate limit error: {e}")
+        return True
+
+def pause_rate_limit(identifier, seconds, max_requests=10, window_seconds=60):
+    """清空令牌桶，使 identifier 在 seconds 秒后才补回第一个令牌（用于遵守对端返回的 retry_after）
+    
+    max_requests / window_seconds 需与 check_rate_limit 使用的参数一致。
+    """
+    now = time.time()
+    rate = max_requests / window_seconds
+    try:
+        with get_db(RATE_LIMIT_DB_PATH) as conn:
+            conn.execute("""
+                INSERT INTO rate_limits (key, tokens, updated_at, expires_at) VALUES (:key, :tokens, :now, :expires)
+                ON CONFLICT(key) DO UPDATE SET tokens = MIN(tokens, :tokens), updated_at = :now, expires_at = :expires
+            """, {"key": identifier, "tokens": 1 - seconds * rate, "now": now, "expires": now + seconds + window_seconds})
+    except sqlite3.Error as e:
+        print(f"Rate limit error: {e}")
+
+# --- 页面与查询缓存 ---
+# 进程内 LRU + TTL 缓存，键为 (命名空间, ...) 元组。数据变化时按命名空间失效：
+#   notice        公告
+#   feed          首页 / 搜索结果页
+#   post:<id>     帖子详情页、相册媒体列表
+#   user          匿名用户的收藏页、个人页
+# 失效事件同时写入 cache_events 表，其他 gunicorn worker 每 CACHE_SYNC_INTERVAL 秒读取一次并同步失效。
+# 首页卡片上的评论数随评论增删失效 feed 命名空间；点赞、拉黑数只随 TTL 过期刷新。
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 512))
+PAGE_CACHE_TTL = float(os.environ.get("PAGE_CACHE_TTL", 30))
+CACHE_SYNC_INTERVAL = 1.0
+CACHE_EVENTS_KEEP_SECONDS = 3600
+
+class TTLCache:
+    """线程安全的 LRU + TTL 缓存，支持按命名空间（键的第一个元素）失效"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+    
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.stats['misses'] += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats['hits'] += 1
+            return item[1]
+    
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+    
+    def invalidate(self, namespace):
+        with self._lock:
+            for key in [k for k in self._data if k[0] == namespace]:
+                del self._data[key]
+                self.stats['invalidations'] += 1
+    
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, size=len(self._data))
+
+page_cache = TTLCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+_cache_sync = {'last_event_id': None, 'last_sync': 0.0, 'last_prune': 0.0}
+_cache_sync_lock = threading.Lock()
+
+def sync_cache_events():
+    """读取其他进程写入的失效事件（每 CACHE_SYNC_INTERVAL 秒最多一次）"""
+    now = time.time()
+    with _cache_sync_lock:
+        if now - _cache_sync['last_sync'] < CACHE_SYNC_INTERVAL:
+            return
+        _cache_sync['last_sync'] = now
+        try:
+            with get_db() as conn:
+                if _cache_sync['last_event_id'] is None:
+                    _cache_sync['last_event_id'] = conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events").fetchone()[0]
+                    return
+                events = conn.execute("SELECT id, namespace FROM cache_events WHERE id>? ORDER BY id", (_cache_sync['last_event_id'],)).fetchall()
+                if now - _cache_sync['last_prune'] > CACHE_EVENTS_KEEP_SECONDS:
+                    conn.execute("DELETE FROM cache_events WHERE created_at<?", (now - CACHE_EVENTS_KEEP_SECONDS,))
+                    _cache_sync['last_prune'] = now
+        except sqlite3.Error as e:
+            print(f"Cache sync error: {e}")
+            return
+        for event in events:
+            page_cache.invalidate(event['namespace'])
+            _cache_sync['last_event_id'] = event['id']
+
+def cache_get(key):
+    sync_cache_events()
+    return page_cache.get(key)
+
+def invalidate_cache(*namespaces):
+    """使本进程的缓存失效，并通知其他 worker
+    
+    需要在写操作的事务提交之后调用（不要在 with get_db() 块内调用）。
+    """
+    for ns in namespaces:
+        page_cache.invalidate(ns)
+    try:
+        with get_db() as conn:
+            conn.executemany("INSERT INTO cache_events (namespace, created_at) VALUES (?, ?)", [(ns, time.time()) for ns in namespaces])
+    except sqlite3.Error as e:
+        print(f"Cache invalidation error: {e}")
+
+def post_namespaces(post_ids):
+    return [f"post:{pid}" for pid in post_ids]
+
+def get_notice():
+    notice = cache_get(('notice',))
+    if notice is None:
+        with get_db() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key='notice'").fetchone()
+        notice = row['value'] if row else ""
+        page_cache.set(('notice',), notice, ttl=3600)
+    return notice
+
+# --- 媒体处理 ---
+VIDEO_EXTS = ('.mp4', '.mov')
+SOURCE_EXTS = ('.jpg', '.jpeg', '.png', '.webp') + VIDEO_EXTS
+
+# 响应式派生图：首次请求时按宽度和格式生成，缓存在 uploads/derived/ 下，
+# 文件名形如 <原文件名>_w320.webp，模板通过 srcset() 输出候选列表
+DERIVED_DIR = os.path.join(UPLOAD_DIR, 'derived')
+DERIVATIVE_WIDTHS = (160, 320, 640, 1280)
+
+CV2_AVIF_RECHECK_SECONDS = 60
+_cv2_avif = {'supported': None, 'checked_at': 0}
+
+def cv2_supports_avif(probe=False):
+    """cv2 能否编码 AVIF
+    
+    探测需要导入 cv2（连同 numpy，是启动最慢的一步），因此只在生成派生图（本来就要导入 cv2）时传 probe=True 探测。
+    结果按 cv2 的安装位置和修改时间缓存在 settings 表，升级或更换 opencv 后自动重新探测；
+    渲染页面时只读缓存（尚未探测时最多每 CV2_AVIF_RECHECK_SECONDS 秒读一次），未探测前按不支持处理。
     """
+    if _cv2_avif['supported'] is not None:
+        return _cv2_avif['supported']
+    if not probe and time.time() - _cv2_avif['checked_at'] < CV2_AVIF_RECHECK_SECONDS:
+        return False
+    _cv2_avif['checked_at'] = time.time()
+    spec = importlib.util.find_spec('cv2')
+    if spec is None or not spec.origin:
+        _cv2_avif['supported'] = False
+        return False
+    fingerprint = f"{spec.origin}:{os.path.getmtime(spec.origin)}"
+    with get_db() as conn:
+        row = conn.execute("SELECT value FROM settings WHERE key='cv2_avif'").fetchone()
+    if row and row['value'].rpartition('|')[0] == fingerprint:
+        _cv2_avif['supported'] = row['value'].endswith('|1')
+        return _cv2_avif['supported']
+    if not probe:
+        return False
+    import cv2
+    supported = hasattr(cv2, 'IMWRITE_AVIF_QUALITY') and cv2.haveImageWriter('x.avif')
+    with get_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('cv2_avif', ?)", (f"{fingerprint}|{int(supported)}",))
+    _cv2_avif['supported'] = supported
+    return supported
+
+# 格式 -> (cv2 编码参数名, 质量)；cv2 在第一次生成图片时才导入，avif 还需 cv2_supports_avif()
+DERIVATIVE_FORMATS = {
+    'webp': ('IMWRITE_WEBP_QUALITY', 80),
+    'jpg': ('IMWRITE_JPEG_QUALITY', 82),
+    'avif': ('IMWRITE_AVIF_QUALITY', 60),
+}
+_DERIVED_NAME = re.compile(r'^(?P<stem>[\w\-]+)_w(?P<width>\d+)\.(?P<fmt>\w+)$')
+os.makedirs(DERIVED_DIR, exist_ok=True)
+
+def read_video_frame(video_path):
+    """读取视频 1 秒处的一帧（视频太短则取第一帧），失败返回 None"""
+    import cv2
     cap = None
     try:
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
             print(f"Thumbnail generation error: Cannot open video file {video_path}")
-            return False
+            return None
             
         # 尝试定位到1秒位置，如果视频太短则使用第一帧
         cap.set(cv2.CAP_PROP_POS_MSEC, 1000)
@@ -158,8 +998,26 @@ def generate_video_thumbnail(video_path, thumbnail_path):
         if not success:
             cap.set(cv2.CAP_PROP_POS_MSEC, 0)
             success, frame = cap.read()
+        return frame if success else None
+    finally:
+        if cap is not None:
+            cap.release()
+
+@instrumented('video_thumbnail_seconds')
+def generate_video_thumbnail(video_path, thumbnail_path):
+    """使用 cv2 生成视频缩略图
+    
+    Args:
+        video_path: 视频文件路径
+        thumbnail_path: 缩略图保存路径
         
-        if success and frame is not None:
+    Returns:
+        bool: 成功返回True，失败返回False
+    """
+    try:
+        import cv2
+        frame = read_video_frame(video_path)
+        if frame is not None:
             # 调整大小到宽度320
             height, width = frame.shape[:2]
             new_width = 320
@@ -171,79 +1029,1524 @@ def generate_video_thumbnail(video_path, thumbnail_path):
     except Exception as e:
         print(f"Thumbnail generation error: {e}")
         return False
-    finally:
-        if cap is not None:
-            cap.release()
 
+@app.template_global()
+def derivative_url(media_url, width, fmt='webp'):
+    """原始媒体 URL 对应的派生图 URL（视频对应其封面帧）"""
+    stem = os.path.splitext(os.path.basename(media_url))[0]
+    return f"/uploads/derived/{stem}_w{width}.{fmt}"
+
+@app.template_global()
+def srcset(media_url, fmt='webp'):
+    """生成 <img srcset> / <source srcset> 的候选列表"""
+    return ', '.join(f"{derivative_url(media_url, w, fmt)} {w}w" for w in DERIVATIVE_WIDTHS)
+
+app.jinja_env.globals.update(DERIVATIVE_WIDTHS=DERIVATIVE_WIDTHS)
+
+@app.template_global()
+def picture_source_types():
+    """<picture> 内 <source> 的格式顺序：AVIF（cv2 支持时）优先，其次 WebP，<img> 本身用 JPEG 兜底
+    
+    AVIF 支持在第一次生成派生图时才探测，探测前的页面只输出 WebP。
+    """
+    return ([('avif', 'image/avif')] if cv2_supports_avif() else []) + [('webp', 'image/webp')]
+
+@app.template_global()
+def picture_sources(media_url, sizes):
+    """<picture> 内的 <source> 标签"""
+    return Markup(''.join(f'<source type="{mime}" srcset="{escape(srcset(media_url, fmt))}" sizes="{escape(sizes)}">'
+                          for fmt, mime in picture_source_types()))
+
+@instrumented('derivative_seconds')
+def generate_derivative(name):
+    """按派生图文件名生成并缓存到 DERIVED_DIR
+    
+    Args:
+        name: 形如 <stem>_w<width>.<fmt> 的文件名
+        
+    Returns:
+        bool: 成功返回True，文件名非法或源文件不存在返回False
+    """
+    m = _DERIVED_NAME.match(name)
+    if not m or int(m['width']) not in DERIVATIVE_WIDTHS or m['fmt'] not in DERIVATIVE_FORMATS:
+        return False
+    source = next((os.path.join(UPLOAD_DIR, m['stem'] + ext) for ext in SOURCE_EXTS
+                   if os.path.exists(os.path.join(UPLOAD_DIR, m['stem'] + ext))), None)
+    if not source:
+        return False
+    # 生成派生图本来就要导入 cv2，顺便完成 AVIF 探测，之后渲染的页面开始输出 AVIF
+    if not cv2_supports_avif(probe=True) and m['fmt'] == 'avif':
+        return False
+    try:
+        import cv2
+        image = read_video_frame(source) if source.lower().endswith(VIDEO_EXTS) else cv2.imread(source)
+        if image is None:
+            return False
+        height, width = image.shape[:2]
+        # 不放大：源图比目标宽度小时保持原尺寸
+        new_width = min(int(m['width']), width)
+        if new_width != width:
+            image = cv2.resize(image, (new_width, int(height * new_width / width)), interpolation=cv2.INTER_AREA)
+        # 先写临时文件再原子替换，避免并发请求读到半个文件
+        tmp_path = os.path.join(DERIVED_DIR, f".{name}.{os.getpid()}.{threading.get_ident()}.{m['fmt']}")
+        param, quality = DERIVATIVE_FORMATS[m['fmt']]
+        if not cv2.imwrite(tmp_path, image, [getattr(cv2, param), quality]):
+            return False
+        os.replace(tmp_path, os.path.join(DERIVED_DIR, name))
+        return True
+    except Exception as e:
+        print(f"Derivative generation error: {e}")
+        return False
+
+# --- 视频快速启动与 HLS ---
+# Telegram 交付的 MP4 常把 moov（索引）放在文件末尾，浏览器要先读到文件末尾才能开始播放。
+# 入库时把 moov 移到 mdat 之前并修正 stco / co64 中的 chunk 偏移（纯 Python，等价于 qt-faststart，不重新编码）。
+# 内容变化后按新的内容哈希另存一份，原文件由 gc 回收，已缓存的旧 URL 不会读到混杂的新旧字节。
+# 设置 HLS_MIN_SECONDS 且系统装有 ffmpeg 时，时长超过该值的视频另外切成 HLS 分片（-c copy，不转码），
+# 存放在 uploads/hls/<stem>/，详情页优先使用。切片不占用入库任务：帖子写入时在同一事务中登记到 hls_queue，
+# 由每个进程的 hls-segmenter 线程领取执行，切好之前详情页播放 MP4。
+HLS_MIN_SECONDS = float(os.environ.get("HLS_MIN_SECONDS", 0))
+HLS_SEGMENT_SECONDS = int(os.environ.get("HLS_SEGMENT_SECONDS", 6))
+HLS_DIR = os.path.join(UPLOAD_DIR, 'hls')
+FFMPEG = shutil.which('ffmpeg')
+HLS_ENABLED = bool(FFMPEG) and HLS_MIN_SECONDS > 0
+HLS_FFMPEG_TIMEOUT = 600
+HLS_LEASE_SECONDS = HLS_FFMPEG_TIMEOUT + 60  # 领取后超过此时间未完成视为进程已崩溃，重新领取
+HLS_MAX_ATTEMPTS = 3
+# 非 Safari 浏览器播放 HLS 需要 hls.js，从本站 static/vendor/ 加载（固定版本，不引用第三方 CDN），文件不存在时详情页直接播放 MP4
+HLS_JS_VERSION = "1.5.17"
+HLS_JS_FILE = f"vendor/hls-{HLS_JS_VERSION}.min.js"
+MP4_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/iso.segment', '.m4s')
+os.makedirs(HLS_DIR, exist_ok=True)
+
+def mp4_box_header(data, offset, end):
+    """解析一个 box 头
+    
+    Args:
+        data: 至少包含 box 头 16 字节的缓冲区
+        offset: box 在所属范围内的起始偏移（用于计算 size=0 的长度）
+        end: 所属范围的结束偏移
+        
+    Returns:
+        tuple: (类型, 头部长度, box 总长度)
+    """
+    size, kind = struct.unpack_from('>I4s', data)
+    header = 8
+    if size == 1:
+        size, header = struct.unpack_from('>Q', data, 8)[0], 16
+    elif size == 0:
+        size = end - offset
+    if size < header or offset + size > end:
+        raise ValueError(f"invalid box {kind!r} at {offset}")
+    return kind, header, size
+
+def read_mp4_boxes(f, start, end):
+    """遍历文件中 [start, end) 范围内的 box
+    
+    Yields:
+        tuple: (类型, 起始偏移, 头部长度, box 总长度)
+    """
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        kind, header, size = mp4_box_header(f.read(16).ljust(16, b'\0'), offset, end)
+        yield kind, offset, header, size
+        offset += size
+
+def read_file_range(f, start, end):
+    """按 DOWNLOAD_CHUNK_SIZE 分块读取文件的 [start, end) 范围"""
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise ValueError("unexpected end of file")
+        remaining -= len(chunk)
+        yield chunk
+
+def patch_chunk_offsets(moov, start, end, shift):
+    """递归修正 moov 中 stco / co64 记录的 chunk 偏移
+    
+    Args:
+        moov: moov box 的 bytearray，原地修改
+        start / end: 当前容器内容在 moov 中的范围
+        shift: 函数，旧文件偏移 -> 新文件偏移
+        
+    Raises:
+        OverflowError: stco 的 32 位偏移放不下新的值
+    """
+    offset = start
+    while offset + 8 <= end:
+        kind, header, size = mp4_box_header(bytes(moov[offset:offset + 16]).ljust(16, b'\0'), offset, end)
+        body = offset + header
+        if kind in MP4_CONTAINER_BOXES:
+            patch_chunk_offsets(moov, body, offset + size, shift)
+        elif kind in (b'stco', b'co64'):
+            code = 'I' if kind == b'stco' else 'Q'
+            count = struct.unpack_from('>I', moov, body + 4)[0]
+            values = [shift(v) for v in struct.unpack_from(f'>{count}{code}', moov, body + 8)]
+            if code == 'I' and values and max(values) > 0xFFFFFFFF:
+                raise OverflowError("stco offset exceeds 32 bits")
+            struct.pack_into(f'>{count}{code}', moov, body + 8, *values)
+        offset += size
+
+def mp4_faststart_chunks(path):
+    """生成 moov 前置后的文件内容
+    
+    新布局：mdat 之前的 box（ftyp 等）-> moov -> 其余 box（保持原顺序）。
+    
+    Returns:
+        iterator: 字节块；已是快速启动、分片 MP4 或缺少 moov / mdat 时返回 None
+        
+    Raises:
+        ValueError / OverflowError: 文件结构无法处理
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        boxes = {kind: (offset, size) for kind, offset, _, size in reversed(list(read_mp4_boxes(f, 0, file_size)))}
+        if b'moov' not in boxes or b'mdat' not in boxes or b'moof' in boxes:
+            return None
+        moov_start, moov_size = boxes[b'moov']
+        insert_at = boxes[b'mdat'][0]  # 第一个 mdat 的位置
+        if moov_start < insert_at:
+            return None
+        f.seek(moov_start)
+        moov = bytearray(f.read(moov_size))
+    # 只有位于插入点和原 moov 之间的数据整体后移 moov_size，原 moov 之后的数据位置不变
+    _, header, _ = mp4_box_header(bytes(moov[:16]), 0, moov_size)
+    patch_chunk_offsets(moov, header, moov_size,
+                        lambda v: v + moov_size if insert_at <= v < moov_start else v)
+    
+    def chunks():
+        with open(path, 'rb') as f:
+            yield from read_file_range(f, 0, insert_at)
+            yield bytes(moov)
+            yield from read_file_range(f, insert_at, moov_start)
+            yield from read_file_range(f, moov_start + moov_size, file_size)
+    return chunks()
+
+def mp4_duration(path):
+    """从 moov/mvhd 读取视频时长（秒），无法解析时返回 None"""
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            moov = next((b for b in read_mp4_boxes(f, 0, file_size) if b[0] == b'moov'), None)
+            if not moov:
+                return None
+            _, offset, header, size = moov
+            for kind, box_offset, box_header, _ in read_mp4_boxes(f, offset + header, offset + size):
+                if kind == b'mvhd':
+                    f.seek(box_offset + box_header)
+                    data = f.read(32)
+                    if data[0] == 1:
+                        timescale, duration = struct.unpack_from('>IQ', data, 20)
+                    else:
+                        timescale, duration = struct.unpack_from('>II', data, 12)
+                    return duration / timescale if timescale else None
+    except (OSError, ValueError, struct.error):
+        pass
+    return None
+
+@instrumented('video_faststart_seconds')
+def faststart_video(name, file_unique_id=None):
+    """把 moov 移到文件开头，结果按内容哈希另存
+    
+    Args:
+        name: UPLOAD_DIR 下的视频文件名
+        file_unique_id: 传入时别名改为指向新文件，同一文件再次出现时直接复用
+        
+    Returns:
+        str: 处理后的文件名，无需处理或处理失败时返回原文件名
+    """
+    path = os.path.join(UPLOAD_DIR, name)
+    try:
+        chunks = mp4_faststart_chunks(path)
+        if chunks is None:
+            return name
+        return store_media_stream(chunks, os.path.splitext(name)[1].lower(), file_unique_id=file_unique_id)
+    except (OSError, ValueError, OverflowError, struct.error) as e:
+        print(f"Faststart skipped for {name}: {e}")
+        return name
+
+@app.template_global()
+def hls_url(media_url):
+    """视频对应的 HLS 播放列表 URL，未切片时返回 None"""
+    stem = os.path.splitext(os.path.basename(media_url))[0]
+    if os.path.exists(os.path.join(HLS_DIR, stem, 'index.m3u8')):
+        return f"/uploads/hls/{stem}/index.m3u8"
+    return None
+
+@app.template_global()
+def hls_js_url():
+    """本地 hls.js 的 URL，未放置文件时返回 None"""
+    if os.path.exists(os.path.join(app.static_folder, HLS_JS_FILE)):
+        return f"/static/{HLS_JS_FILE}"
+    return None
+
+@instrumented('video_hls_seconds')
+def segment_video_hls(name):
+    """用 ffmpeg 把视频切成 HLS（fMP4 分片，不转码），未启用、时长不足或 ffmpeg 不可用时跳过
+    
+    Returns:
+        bool: 播放列表已存在或生成成功返回 True
+    """
+    stem = os.path.splitext(name)[0]
+    out_dir = os.path.join(HLS_DIR, stem)
+    if os.path.exists(os.path.join(out_dir, 'index.m3u8')):
+        return True
+    if not HLS_ENABLED:
+        return False
+    path = os.path.join(UPLOAD_DIR, name)
+    duration = mp4_duration(path)
+    if duration is None or duration < HLS_MIN_SECONDS:
+        return False
+    # 在临时目录中生成，完成后整体重命名，避免播放到写了一半的播放列表
+    tmp_dir = os.path.join(HLS_DIR, f".tmp-{stem}-{os.getpid()}-{threading.get_ident()}")
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        subprocess.run([FFMPEG, '-v', 'error', '-y', '-i', path, '-c', 'copy', '-f', 'hls',
+                        '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+                        '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', 'init.mp4',
+                        '-hls_segment_filename', 'seg_%05d.m4s', 'index.m3u8'],
+                       cwd=tmp_dir, check=True, capture_output=True, timeout=HLS_FFMPEG_TIMEOUT)
+        os.rename(tmp_dir, out_dir)
+        return True
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"HLS segmenting error for {name}: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return os.path.exists(os.path.join(out_dir, 'index.m3u8'))
+
+def prepare_video(name, file_unique_id=None):
+    """入库视频的后处理：moov 前置、生成封面（HLS 切片在帖子写入后由 hls_queue 异步执行）
+    
+    Returns:
+        tuple: (处理后的文件名, 封面 URL)
+    """
+    name = faststart_video(name, file_unique_id)
+    thumbnail = ensure_video_thumbnail(name)
+    return name, thumbnail
+
+def enqueue_hls(conn, media_urls):
+    """把需要切 HLS 的视频登记到 hls_queue（在调用方的事务中，帖子提交后才可见）"""
+    if not HLS_ENABLED:
+        return
+    now = time.time()
+    conn.executemany("INSERT OR IGNORE INTO hls_queue (name, created_at) VALUES (?, ?)",
+                     [(os.path.basename(u), now) for u in media_urls if u and u.lower().endswith(VIDEO_EXTS)])
+
+def claim_hls_job():
+    """领取一个切片任务，超过租期未完成的任务可被重新领取
+    
+    Returns:
+        str: 视频文件名，没有任务时返回 None
+    """
+    now = time.time()
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM hls_queue WHERE attempts>=? AND claimed_at<?", (HLS_MAX_ATTEMPTS, now - HLS_LEASE_SECONDS))
+        row = conn.execute("SELECT name FROM hls_queue WHERE claimed_at<? ORDER BY created_at LIMIT 1",
+                           (now - HLS_LEASE_SECONDS,)).fetchone()
+        if not row:
+            return None
+        conn.execute("UPDATE hls_queue SET attempts=attempts+1, claimed_at=? WHERE name=?", (now, row['name']))
+    return row['name']
+
+def hls_worker():
+    """后台线程：循环领取并执行 HLS 切片"""
+    while True:
+        try:
+            name = claim_hls_job()
+        except sqlite3.Error as e:
+            print(f"HLS queue error: {e}")
+            name = None
+        if not name:
+            time.sleep(5)
+            continue
+        # 失败已在 segment_video_hls 中记录，不再重试（可用 flask faststart --hls 补切）
+        segment_video_hls(name)
+        with get_db() as conn:
+            conn.execute("DELETE FROM hls_queue WHERE name=?", (name,))
+
+# --- 媒体下载 ---
+# 所有下载复用进程内同一个 keep-alive 连接池，避免每个文件重新 TLS 握手；大块读取减少 Python 循环开销。
+# 消息里带有 file_unique_id，已入库过的文件直接复用，连 getFile 都不用调用。
+# TELEGRAM_API_URL 可指向自建 Bot API 服务器（支持更大文件）或本地桩服务（benchmarks/tg_stub.py）。
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip('/')
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+DOWNLOAD_MAX_BYTES = int(os.environ.get("DOWNLOAD_MAX_BYTES", 20 * 1024 * 1024))  # 官方 Bot API 的下载上限
+DOWNLOAD_POOL_SIZE = int(os.environ.get("DOWNLOAD_POOL_SIZE", 8))
+DOWNLOAD_TIMEOUT = (10, 60)  # 连接 / 读取超时（秒）
+
+_telebot = {'module': None}
+_telebot_lock = threading.Lock()
+
+def load_telebot():
+    """第一次用到时导入 telebot 并完成全局配置（Bot API 地址、调用计时）
+    
+    Returns:
+        module: telebot 模块
+    """
+    with _telebot_lock:
+        if _telebot['module'] is None:
+            import telebot
+            telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+            telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+            instrument_telebot(telebot.apihelper)
+            _telebot['module'] = telebot
+        return _telebot['module']
+
+_http = {'pid': None, 'session': None}
+_http_lock = threading.Lock()
+download_stats = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'reused': 0, 'too_large': 0, 'errors': 0}
+_download_stats_lock = threading.Lock()
+
+class MediaTooLarge(Exception):
+    """媒体文件超过 DOWNLOAD_MAX_BYTES"""
+
+def get_http_session():
+    """返回当前进程共享的 requests.Session（gunicorn fork 后重建，不与父进程共用 socket）"""
+    with _http_lock:
+        if _http['pid'] != os.getpid():
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=DOWNLOAD_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http.update(pid=os.getpid(), session=session)
+        return _http['session']
+
+def ensure_video_thumbnail(name):
+    """确保视频封面 <stem>_thumb.jpg 存在
+    
+    Returns:
+        str: 封面 URL，生成失败返回 None
+    """
+    thumb_name = f"{os.path.splitext(name)[0]}_thumb.jpg"
+    thumb_path = os.path.join(UPLOAD_DIR, thumb_name)
+    if os.path.exists(thumb_path) or generate_video_thumbnail(os.path.join(UPLOAD_DIR, name), thumb_path):
+        return f"/uploads/{thumb_name}"
+    return None
+
+def store_media_stream(chunks, ext, file_unique_id=None, max_bytes=None):
+    """边下载边计算 sha256，写入临时文件后原子重命名为 <sha256><ext>，并登记到 media 表
+    
+    相同内容（即使 file_id 不同）只保存一份。media.refcount 由 post_media 上的触发器维护，
+    引用媒体必须经由 post_media 行（save_post / ingest_edit），否则垃圾回收会把文件当作无人引用。
+    
+    Args:
+        chunks: 字节块迭代器
+        ext: 文件后缀（如 .jpg）
+        file_unique_id: Telegram 文件唯一标识，记录后同一文件再次出现时免下载
+        max_bytes: 超过此大小抛出 MediaTooLarge，临时文件随即删除
+        
+    Returns:
+        str: 保存后的文件名
+    """
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(UPLOAD_DIR, f".tmp-{os.getpid()}-{threading.get_ident()}-{time.time_ns()}")
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise MediaTooLarge(f"超过 {max_bytes} 字节")
+                digest.update(chunk)
+                f.write(chunk)
+        name = digest.hexdigest() + ext
+        target_path = os.path.join(UPLOAD_DIR, name)
+        if os.path.exists(target_path):
+            # 复用已有文件：刷新 mtime，垃圾回收按 mtime 判断宽限期，不会在登记前删掉它
+            os.utime(target_path)
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # touched_at 刷新后，垃圾回收在宽限期内不会回收这份文件
+    with get_db() as conn:
+        conn.execute("""INSERT INTO media (hash, path, size, refcount, touched_at) VALUES (?, ?, ?, 0, ?)
+                        ON CONFLICT(hash) DO UPDATE SET touched_at=excluded.touched_at""",
+                     (digest.hexdigest(), f"/uploads/{name}", size, time.time()))
+        if file_unique_id:
+            conn.execute("INSERT OR REPLACE INTO media_aliases (file_unique_id, hash) VALUES (?, ?)",
+                         (file_unique_id, digest.hexdigest()))
+    return name
+
+def lookup_media_alias(file_unique_id):
+    """按 file_unique_id 查找已入库的文件
+    
+    Returns:
+        str: 文件名，未入库或文件已被回收返回 None
+    """
+    if not file_unique_id:
+        return None
+    with get_db() as conn:
+        row = conn.execute("""SELECT m.hash, m.path FROM media_aliases a JOIN media m ON m.hash=a.hash
+                              WHERE a.file_unique_id=?""", (file_unique_id,)).fetchone()
+        if not row:
+            return None
+        name = os.path.basename(row['path'])
+        try:
+            os.utime(os.path.join(UPLOAD_DIR, name))
+        except FileNotFoundError:
+            return None
+        conn.execute("UPDATE media SET touched_at=? WHERE hash=?", (time.time(), row['hash']))
+    return name
+
+def fetch_telegram_file(media_obj, ext):
+    """通过 getFile 取得路径后流式下载并按内容哈希保存
+    
+    Args:
+        media_obj: PhotoSize / Video 对象
+        ext: 文件后缀
+        
+    Returns:
+        str: 保存后的文件名
+        
+    Raises:
+        MediaTooLarge: 文件超过 DOWNLOAD_MAX_BYTES
+    """
+    # 消息本身带有 file_size 时提前拒绝，省掉 getFile 和下载
+    if media_obj.file_size and media_obj.file_size > DOWNLOAD_MAX_BYTES:
+        raise MediaTooLarge(f"{media_obj.file_size} 字节超过上限 {DOWNLOAD_MAX_BYTES}")
+    file_info = bot.get_file(media_obj.file_id)
+    start = time.perf_counter()
+    with get_http_session().get(f"{TELEGRAM_API_URL}/file/bot{BOT_TOKEN}/{file_info.file_path}",
+                                stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        if int(r.headers.get('Content-Length') or 0) > DOWNLOAD_MAX_BYTES:
+            raise MediaTooLarge(f"{r.headers['Content-Length']} 字节超过上限 {DOWNLOAD_MAX_BYTES}")
+        name = store_media_stream(r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE), ext,
+                                  file_unique_id=media_obj.file_unique_id, max_bytes=DOWNLOAD_MAX_BYTES)
+    size = os.path.getsize(os.path.join(UPLOAD_DIR, name))
+    metrics.inc('media_download_bytes_total', size)
+    with _download_stats_lock:
+        download_stats['files'] += 1
+        download_stats['bytes'] += size
+        download_stats['seconds'] += time.perf_counter() - start
+    return name
+
+@instrumented('media_download_seconds')
 def download_media(p):
+    """下载消息中的图片或视频
+    
+    Returns:
+        tuple: (媒体 URL, 视频封面 URL)，没有媒体或下载失败（可重试）时为 (None, None)
+    
+    Raises:
+        MediaTooLarge: 文件超过 DOWNLOAD_MAX_BYTES，重试也不会成功
+    """
     media_obj = p.photo[-1] if p.photo else (p.video if p.video else None)
     if not media_obj: return None, None
     
     # 获取后缀
     ext = ".jpg" if p.photo else ".mp4"
-    save_name = f"{media_obj.file_id}{ext}"
-    target_path = os.path.join(UPLOAD_DIR, save_name)
-    thumbnail_path = None
-    
-    if os.path.exists(target_path): 
-        # 检查缩略图是否存在，如果不存在则生成
-        if ext == ".mp4":
-            thumb_name = f"{media_obj.file_id}_thumb.jpg"
-            thumb_path = os.path.join(UPLOAD_DIR, thumb_name)
-            if os.path.exists(thumb_path):
-                # 缩略图已存在
-                thumbnail_path = f"/uploads/{thumb_name}"
+    
+    # 兼容旧版本按 file_id 命名的文件
+    legacy_name = f"{media_obj.file_id}{ext}"
+    if os.path.exists(os.path.join(UPLOAD_DIR, legacy_name)):
+        name = legacy_name
+    else:
+        name = lookup_media_alias(getattr(media_obj, 'file_unique_id', None))
+        if name:
+            with _download_stats_lock:
+                download_stats['reused'] += 1
+        else:
+            try:
+                name = fetch_telegram_file(media_obj, ext)
+            except MediaTooLarge as e:
+                with _download_stats_lock:
+                    download_stats['too_large'] += 1
+                print(f"Download Skipped: {e}")
+                raise
+            except Exception as e:
+                with _download_stats_lock:
+                    download_stats['errors'] += 1
+                print(f"Download Error: {e}")
+                return None, None
+    # 视频：moov 前置、生成封面（内容重复时复用已有封面）
+    if ext == ".mp4":
+        name, thumbnail = prepare_video(name, getattr(media_obj, 'file_unique_id', None))
+        return f"/uploads/{name}", thumbnail
+    return f"/uploads/{name}", None
+
+# --- 媒体垃圾回收 ---
+# 回收三类文件：refcount 归零的 media 记录对应的文件、uploads 下未被任何帖子或 media 记录引用的文件
+# （包括旧版本按 file_id 命名的文件、_thumb.jpg 封面和 moov 前置前的原始视频）、源文件已不存在的派生图和 HLS 分片。
+# 最近 MEDIA_GC_GRACE_SECONDS 内写入或复用的文件不回收，避免与正在进行的入库冲突。
+MEDIA_GC_GRACE_SECONDS = 3600
+
+def media_stem(url_or_name):
+    """文件名去掉后缀及 _thumb 标记，同一媒体的原文件、封面、派生图共享同一个 stem"""
+    name = os.path.basename(url_or_name)
+    if name.endswith('_thumb.jpg'):
+        return name[:-len('_thumb.jpg')]
+    return os.path.splitext(name)[0]
+
+def collect_media_garbage(dry_run=False):
+    """回收不再被引用的媒体文件
+    
+    Args:
+        dry_run: 只统计不删除
+        
+    Returns:
+        dict: {'files': 删除文件数, 'bytes': 释放字节数, 'media_rows': 删除的 media 记录数}
+    """
+    cutoff = time.time() - MEDIA_GC_GRACE_SECONDS
+    freed = {'files': 0, 'bytes': 0, 'media_rows': 0}
+    
+    def remove(path):
+        try:
+            size = os.path.getsize(path)
+            if not dry_run:
+                os.remove(path)
+        except OSError:
+            return
+        freed['files'] += 1
+        freed['bytes'] += size
+    
+    with get_db() as conn:
+        orphans = conn.execute("SELECT hash, path FROM media WHERE refcount<=0 AND touched_at<?", (cutoff,)).fetchall()
+        freed['media_rows'] = len(orphans)
+        if not dry_run:
+            # 查询之后被重新引用或复用（touched_at 刷新）的记录不删除
+            freed['media_rows'] = conn.executemany("DELETE FROM media WHERE hash=? AND refcount<=0 AND touched_at<?",
+                                                   [(r['hash'], cutoff) for r in orphans]).rowcount
+            conn.execute("DELETE FROM media_aliases WHERE hash NOT IN (SELECT hash FROM media)")
+        live = set()
+        for r in conn.execute("SELECT first_media as media, thumbnail FROM posts UNION SELECT media, thumbnail FROM post_media"):
+            live.update(media_stem(u) for u in (r['media'], r['thumbnail']) if u)
+        live.update(media_stem(r['path']) for r in conn.execute("SELECT path FROM media WHERE refcount>0 OR touched_at>=?", (cutoff,)))
+    
+    for entry in os.scandir(UPLOAD_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff and media_stem(entry.name) not in live:
+            remove(entry.path)
+    for entry in os.scandir(DERIVED_DIR):
+        m = _DERIVED_NAME.match(entry.name)
+        if entry.is_file() and entry.stat().st_mtime < cutoff and (not m or m['stem'] not in live):
+            remove(entry.path)
+    for entry in os.scandir(HLS_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff and entry.name not in live:
+            for segment in os.scandir(entry.path):
+                remove(segment.path)
+            if not dry_run:
+                shutil.rmtree(entry.path, ignore_errors=True)
+    return freed
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f"{n:.1f} {unit}" if unit != 'B' else f"{n} B"
+        n /= 1024
+
+@app.cli.command('gc')
+@click.option('--dry-run', is_flag=True, help='只统计可回收的空间，不删除文件')
+def gc_command(dry_run):
+    """回收不再被引用的媒体文件（flask --app app gc）"""
+    freed = collect_media_garbage(dry_run=dry_run)
+    action = "可回收" if dry_run else "已回收"
+    click.echo(f"{action} {freed['files']} 个文件，{format_bytes(freed['bytes'])}，清理 media 记录 {freed['media_rows']} 条")
+
+def replace_video_references(old_name, new_name):
+    """把帖子中对 old_name 的引用（连同封面和 file_unique_id 别名）改为 new_name
+    
+    Returns:
+        list: 受影响的帖子 ID
+    """
+    old_url, new_url = f"/uploads/{old_name}", f"/uploads/{new_name}"
+    # 内容只是换了排列，封面帧相同，直接复制旧封面
+    old_thumb = os.path.join(UPLOAD_DIR, f"{os.path.splitext(old_name)[0]}_thumb.jpg")
+    new_thumb = os.path.join(UPLOAD_DIR, f"{os.path.splitext(new_name)[0]}_thumb.jpg")
+    if os.path.exists(old_thumb) and not os.path.exists(new_thumb):
+        shutil.copyfile(old_thumb, new_thumb)
+    thumbnail = ensure_video_thumbnail(new_name)
+    with get_db() as conn:
+        post_ids = [r[0] for r in conn.execute("SELECT post_id FROM post_media WHERE media=? UNION SELECT id FROM posts WHERE first_media=?",
+                                               (old_url, old_url))]
+        conn.execute("UPDATE post_media SET media=?, thumbnail=COALESCE(?, thumbnail) WHERE media=?", (new_url, thumbnail, old_url))
+        conn.execute("UPDATE posts SET first_media=?, thumbnail=COALESCE(?, thumbnail) WHERE first_media=?", (new_url, thumbnail, old_url))
+        conn.execute("""UPDATE media_aliases SET hash=(SELECT hash FROM media WHERE path=?)
+                        WHERE hash=(SELECT hash FROM media WHERE path=?)""", (new_url, old_url))
+    return post_ids
+
+@app.cli.command('faststart')
+@click.option('--hls', is_flag=True, help='同时为时长超过 HLS_MIN_SECONDS 的视频切 HLS 分片（需要 ffmpeg）')
+@click.option('--dry-run', is_flag=True, help='只统计需要处理的视频，不修改文件')
+def faststart_command(hls, dry_run):
+    """把已入库视频的 moov 移到文件开头（flask --app app faststart）"""
+    if hls and not HLS_ENABLED:
+        click.echo("HLS 未启用：需要设置 HLS_MIN_SECONDS 并安装 ffmpeg")
+        hls = False
+    with get_db() as conn:
+        urls = [r[0] for r in conn.execute("SELECT media FROM post_media UNION SELECT first_media FROM posts")
+                if r[0] and r[0].lower().endswith(VIDEO_EXTS)]
+    stats = defaultdict(int)
+    post_ids = set()
+    for url in urls:
+        name = os.path.basename(url)
+        if not os.path.exists(os.path.join(UPLOAD_DIR, name)):
+            stats['missing'] += 1
+            continue
+        if dry_run:
+            try:
+                stats['pending' if mp4_faststart_chunks(os.path.join(UPLOAD_DIR, name)) else 'ok'] += 1
+            except (OSError, ValueError, OverflowError, struct.error):
+                stats['unsupported'] += 1
+            continue
+        new_name = faststart_video(name)
+        if new_name != name:
+            post_ids.update(replace_video_references(name, new_name))
+            stats['converted'] += 1
+        else:
+            stats['ok'] += 1
+        if hls and segment_video_hls(new_name):
+            stats['hls'] += 1
+    if post_ids:
+        invalidate_cache('feed', 'user', *post_namespaces(post_ids))
+    click.echo(f"共 {len(urls)} 个视频：" + "，".join(f"{k} {v}" for k, v in sorted(stats.items())))
+
+# --- 媒体文件服务 ---
+# 上传文件按内容哈希（旧文件按 Telegram file_id）命名、派生图由源文件确定性生成，内容永不改变，
+# 因此使用一年期 immutable 缓存和基于文件名的强 ETag。
+# UPLOADS_ACCEL=nginx 时返回 X-Accel-Redirect 交给前置 nginx 发送文件（需配置 internal location），
+# UPLOADS_ACCEL=sendfile 时使用 X-Sendfile（Apache / lighttpd），均不占用 Python worker 传输字节。
+UPLOADS_ACCEL = os.environ.get("UPLOADS_ACCEL", "").lower()
+UPLOADS_ACCEL_PREFIX = os.environ.get("UPLOADS_ACCEL_PREFIX", "/protected_uploads/")
+UPLOADS_MAX_AGE = 365 * 86400
+app.config['USE_X_SENDFILE'] = UPLOADS_ACCEL == 'sendfile'
+
+def upload_etag(filename, size):
+    """内容寻址文件的强 ETag：文件名 + 大小即可唯一确定内容"""
+    return hashlib.sha1(f"{filename}:{size}".encode()).hexdigest()[:20]
+
+@app.route('/uploads/<path:filename>')
+def serve_uploads(filename):
+    # 派生图首次访问时生成，之后直接命中磁盘缓存
+    if filename.startswith('derived/') and not os.path.exists(os.path.join(UPLOAD_DIR, filename)):
+        if not generate_derivative(filename[len('derived/'):]):
+            return "404", 404
+    path = safe_join(UPLOAD_DIR, filename)
+    if not path or not os.path.isfile(path):
+        return "404", 404
+    etag = upload_etag(filename, os.path.getsize(path))
+    
+    if UPLOADS_ACCEL == 'nginx':
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = UPLOADS_ACCEL_PREFIX + filename
+        response.set_etag(etag)
+    else:
+        # send_from_directory 负责 If-None-Match（304）和 Range（206，按偏移 seek 读取）
+        response = send_from_directory(UPLOAD_DIR, filename, etag=etag, max_age=UPLOADS_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = UPLOADS_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+# --- 入库队列 ---
+# webhook 只负责把更新写入 ingest_queue，后台 worker 负责下载、生成缩略图和写入 posts，
+# 避免大视频占用 gunicorn worker 导致 Telegram 超时重发
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", 5))
+INGEST_LEASE_SECONDS = 600  # processing 状态超过此时间视为 worker 已崩溃，重新领取
+INGEST_KEEP_DONE_SECONDS = 86400
+
+# 相册的每一项都是单独的 update：入队时把同一相册已排队的任务统一推迟 ALBUM_DEBOUNCE_SECONDS，
+# 窗口结束后一次领取全部条目，合并为一条帖子写入，审核提醒和管理员链接也只发一次
+ALBUM_DEBOUNCE_SECONDS = float(os.environ.get("ALBUM_DEBOUNCE_MS", 1500)) / 1000
+
+_ingest_wakeup = threading.Event()
+
+def enqueue_ingest(payload, group_key=None):
+    """把原始 update JSON 写入入库队列
+    
+    Args:
+        payload: update JSON
+        group_key: 相册 media_group_id，同组任务会被一起领取
+    """
+    now = time.time()
+    ready_at = now + ALBUM_DEBOUNCE_SECONDS if group_key else now
+    with get_db() as conn:
+        conn.execute("INSERT INTO ingest_queue (payload, group_key, status, attempts, next_attempt_at, created_at, updated_at) VALUES (?, ?, 'pending', 0, ?, ?, ?)",
+                     (payload, group_key, ready_at, now, now))
+        if group_key:
+            # 相册还在陆续到达，整组顺延
+            conn.execute("UPDATE ingest_queue SET next_attempt_at=? WHERE group_key=? AND status='pending' AND attempts=0",
+                         (ready_at, group_key))
+    _ingest_wakeup.set()
+
+def claim_ingest_jobs():
+    """领取一个到期的任务，相册任务连同同组的其他待处理任务一起领取
+    
+    BEGIN IMMEDIATE 保证多进程下不会重复领取。同一相册还有任务在处理中（租期未过）时不领取该相册
+    后到的条目，等前一批提交后再领取，save_post() 才能找到已入库的相册帖子并追加，而不是再建一条。
+    
+    Returns:
+        list: sqlite3.Row 列表，没有到期任务时为空
+    """
+    now = time.time()
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        job = conn.execute("""SELECT id, payload, attempts, group_key FROM ingest_queue
+                              WHERE ((status='pending' AND next_attempt_at<=?)
+                                     OR (status='processing' AND updated_at<?))
+                                AND (group_key IS NULL OR NOT EXISTS (
+                                     SELECT 1 FROM ingest_queue x WHERE x.group_key=ingest_queue.group_key
+                                     AND x.status='processing' AND x.updated_at>=?))
+                              ORDER BY id LIMIT 1""", (now, now - INGEST_LEASE_SECONDS, now - INGEST_LEASE_SECONDS)).fetchone()
+        if not job:
+            return []
+        jobs = [job]
+        if job['group_key']:
+            jobs += conn.execute("""SELECT id, payload, attempts, group_key FROM ingest_queue
+                                    WHERE group_key=? AND id<>? AND (status='pending' OR (status='processing' AND updated_at<?))
+                                    ORDER BY id""", (job['group_key'], job['id'], now - INGEST_LEASE_SECONDS)).fetchall()
+        conn.executemany("UPDATE ingest_queue SET status='processing', attempts=attempts+1, updated_at=? WHERE id=?",
+                         [(now, j['id']) for j in jobs])
+    return jobs
+
+def finish_ingest_jobs(jobs, error=None, permanent=False):
+    """记录任务结果，失败时按指数退避重新排队，超过最大次数或 permanent 时标记为 failed"""
+    now = time.time()
+    with get_db() as conn:
+        for job in jobs:
+            attempts = job['attempts'] + 1
+            if error is None:
+                conn.execute("UPDATE ingest_queue SET status='done', last_error=NULL, updated_at=? WHERE id=?", (now, job['id']))
+            elif permanent or attempts >= INGEST_MAX_ATTEMPTS:
+                conn.execute("UPDATE ingest_queue SET status='failed', last_error=?, updated_at=? WHERE id=?", (error, now, job['id']))
             else:
-                # 尝试生成缩略图
-                if generate_video_thumbnail(target_path, thumb_path):
-                    thumbnail_path = f"/uploads/{thumb_name}"
-        return f"/uploads/{save_name}", thumbnail_path
+                delay = min(300, 5 * 2 ** (attempts - 1))
+                conn.execute("UPDATE ingest_queue SET status='pending', last_error=?, next_attempt_at=?, updated_at=? WHERE id=?",
+                             (error, now + delay, now, job['id']))
+
+def save_post(conn, items, media_group_id, title, date, is_approved, user_id=None):
+    """把一条消息或一个相册写入 posts + post_media
+    
+    相册已有帖子时（条目晚于去抖窗口到达、或重试）把新条目追加到原帖子，并按 msg_id 重排顺序。
+    
+    Args:
+        conn: 数据库连接（调用方负责事务）
+        items: [(msg_id, text, media, thumbnail), ...]，按 msg_id 升序
+        media_group_id: 相册 ID，单条消息为 None
+        title / date / is_approved / user_id: 新建帖子时使用的字段
         
+    Returns:
+        tuple: (post_id, 是否新建帖子)
+    """
+    msg_ids = [i[0] for i in items]
+    text = next((i[1] for i in items if i[1]), "")
+    row = conn.execute(f"SELECT post_id FROM post_media WHERE msg_id IN ({','.join('?' * len(msg_ids))}) LIMIT 1", msg_ids).fetchone()
+    if not row and media_group_id:
+        row = conn.execute("SELECT id as post_id FROM posts WHERE media_group_id=? ORDER BY id LIMIT 1", (media_group_id,)).fetchone()
+    
+    if row:
+        post_id = row['post_id']
+        conn.executemany("INSERT OR IGNORE INTO post_media (post_id, position, msg_id, media, thumbnail) VALUES (?, 1000000, ?, ?, ?)",
+                         [(post_id, m, media, thumb) for m, _, media, thumb in items])
+        conn.execute("""UPDATE post_media SET position=(SELECT COUNT(*) FROM post_media x WHERE x.post_id=post_media.post_id AND x.msg_id<post_media.msg_id)
+                        WHERE post_id=?""", (post_id,))
+        conn.execute("""UPDATE posts SET
+                            first_media=(SELECT media FROM post_media WHERE post_id=posts.id ORDER BY position LIMIT 1),
+                            thumbnail=(SELECT thumbnail FROM post_media WHERE post_id=posts.id ORDER BY position LIMIT 1),
+                            text=CASE WHEN COALESCE(text, '')='' THEN ? ELSE text END
+                        WHERE id=?""", (text, post_id))
+        enqueue_hls(conn, [media for _, _, media, _ in items])
+        return post_id, False
+    
+    _, _, first_media, first_thumb = items[0]
+    cursor = conn.execute("INSERT INTO posts (msg_id, text, title, date, media_group_id, first_media, thumbnail, is_approved, user_id) VALUES (?,?,?,?,?,?,?,?,?)",
+                          (msg_ids[0], text, title, date, media_group_id, first_media, first_thumb, is_approved, user_id))
+    post_id = cursor.lastrowid
+    conn.executemany("INSERT INTO post_media (post_id, position, msg_id, media, thumbnail) VALUES (?, ?, ?, ?, ?)",
+                     [(post_id, pos, m, media, thumb) for pos, (m, _, media, thumb) in enumerate(items)])
+    enqueue_hls(conn, [media for _, _, media, _ in items])
+    return post_id, True
+
+def ingest_edit(update):
+    """处理编辑过的消息：替换对应的媒体条目，相册第一项同时更新封面"""
+    p = update.edited_channel_post or update.edited_message
+    txt = p.text or p.caption or ""
+    path, thumbnail = download_media(p)
+    if not path:
+        raise RuntimeError(f"download failed for message {p.message_id}")
+    with get_db() as conn:
+        row = conn.execute("SELECT post_id, position FROM post_media WHERE msg_id=?", (p.message_id,)).fetchone()
+        if not row:
+            return
+        conn.execute("UPDATE post_media SET media=?, thumbnail=? WHERE msg_id=?", (path, thumbnail, p.message_id))
+        enqueue_hls(conn, [path])
+        if row['position'] == 0:
+            conn.execute("UPDATE posts SET first_media=?, thumbnail=? WHERE id=?", (path, thumbnail, row['post_id']))
+        # 相册的说明文字只在其中一项上，其余项编辑时不覆盖
+        if txt or row['position'] == 0:
+            conn.execute("UPDATE posts SET text=? WHERE id=?", (txt, row['post_id']))
+    invalidate_cache('feed', f"post:{row['post_id']}")
+
+def ingest_updates(updates):
+    """处理一条带媒体的消息或同一相册的全部消息：下载、生成缩略图、写入帖子并通知管理员
+    
+    相册中下载成功的条目先入库，失败的条目由队列单独重试，重试成功后追加到同一帖子。
+    
+    Returns:
+        dict: {updates 中的下标: (错误信息, 是否永久失败)}，全部成功时为空
+    """
+    if updates[0].edited_channel_post or updates[0].edited_message:
+        for update in updates:
+            ingest_edit(update)
+        return {}
+    
+    is_channel = bool(updates[0].channel_post)
+    messages = sorted(((i, u.channel_post or u.message) for i, u in enumerate(updates)), key=lambda x: x[1].message_id)
+    items, failures = [], {}
+    for i, p in messages:
+        try:
+            path, thumbnail = download_media(p)
+        except MediaTooLarge as e:
+            failures[i] = (f"message {p.message_id}: {e}", True)
+            continue
+        if not path:
+            failures[i] = (f"download failed for message {p.message_id}", False)
+            continue
+        items.append((p.message_id, p.text or p.caption or "", path, thumbnail))
+    if not items:
+        return failures
+    
+    p = messages[0][1]
+    uid = p.from_user.id if p.from_user else None
+    with get_db() as conn:
+        new_id, created = save_post(conn, items, p.media_group_id, "官方" if is_channel else "投稿",
+                                    datetime.now().strftime("%Y-%m-%d"), 1 if is_channel else 0, uid)
+    if is_channel or not created:
+        invalidate_cache('feed', f"post:{new_id}")
+    # 迟到的相册条目、重试或 Telegram 重发的重复消息不再重复通知
+    if not created:
+        return failures
+    
+    txt = next((i[1] for i in items if i[1]), "")
+    # 5. 投稿审核提醒
+    if not is_channel and str(uid) != str(MY_CHAT_ID):
+        types = load_telebot().types
+        markup = types.InlineKeyboardMarkup().row(
+            types.InlineKeyboardButton("✅通过", callback_data=f"y_{new_id}"),
+            types.InlineKeyboardButton("❌拒绝", callback_data=f"n_{new_id}")
+        )
+        album_note = f"（相册 {len(items)} 项）" if len(items) > 1 else ""
+        notify_admin(f"🔔 新投稿{album_note}:\n{txt[:100]}", reply_markup=markup.to_json())
+    
+    # 6. 发送管理员链接（连续发布的帖子合并为一条通知）
+    if is_channel:
+        admin_url = f"{BASE_URL}/post/{new_id}?admin_key={ADMIN_KEY}"
+        album_note = f"（相册 {len(items)} 项）" if len(items) > 1 else ""
+        notify_admin(f"📢 新帖子 #{new_id} 已发布{album_note}\n🔗 {admin_url}", coalesce_key='channel_posts')
+    return failures
+
+def ingest_worker():
+    """后台 worker：循环领取并处理入库任务"""
+    last_cleanup = 0
+    while True:
+        try:
+            jobs = claim_ingest_jobs()
+        except sqlite3.Error as e:
+            print(f"Ingest queue error: {e}")
+            time.sleep(1)
+            continue
+        if not jobs:
+            # 空闲时顺便清理已完成的旧任务
+            if time.time() - last_cleanup > 3600:
+                with get_db() as conn:
+                    conn.execute("DELETE FROM ingest_queue WHERE status='done' AND updated_at<?", (time.time() - INGEST_KEEP_DONE_SECONDS,))
+                last_cleanup = time.time()
+            _ingest_wakeup.wait(1)
+            _ingest_wakeup.clear()
+            continue
+        try:
+            failures = ingest_updates([load_telebot().types.Update.de_json(job['payload']) for job in jobs])
+        except Exception as e:
+            print(f"Ingest Error (jobs {[job['id'] for job in jobs]}): {e}")
+            finish_ingest_jobs(jobs, error=str(e)[:500], permanent=isinstance(e, MediaTooLarge))
+            continue
+        finish_ingest_jobs([job for i, job in enumerate(jobs) if i not in failures])
+        for i, (error, permanent) in failures.items():
+            print(f"Ingest Error (job {jobs[i]['id']}): {error}")
+            finish_ingest_jobs([jobs[i]], error=error[:500], permanent=permanent)
+
+def get_ingest_status():
+    """入库队列状态汇总：各状态数量及最近失败的任务"""
+    with get_db() as conn:
+        counts = {r['status']: r['n'] for r in conn.execute("SELECT status, COUNT(*) as n FROM ingest_queue GROUP BY status")}
+        failed = conn.execute("SELECT id, attempts, last_error, updated_at FROM ingest_queue WHERE status='failed' ORDER BY id DESC LIMIT 10").fetchall()
+        oldest = conn.execute("SELECT MIN(created_at) as t FROM ingest_queue WHERE status IN ('pending', 'processing')").fetchone()['t']
+    return {
+        "counts": {k: counts.get(k, 0) for k in ('pending', 'processing', 'done', 'failed')},
+        "oldest_pending_seconds": round(time.time() - oldest, 1) if oldest else 0,
+        "recent_failures": [dict(r) for r in failed],
+    }
+
+# --- 消息发送队列 ---
+# 发给 Telegram 的消息（审核提醒、管理员链接、指令回复、回调应答）先写入 outbox 表，
+# 由每个进程的 dispatcher 线程按速率限制发送：每个会话 OUTBOX_CHAT_RATE 条/秒（允许短时突发 OUTBOX_CHAT_BURST 条），
+# 全局 OUTBOX_GLOBAL_RATE 条/秒，令牌桶复用 ratelimit.db，多个 gunicorn worker 共享同一额度。
+# 收到 429 时按 retry_after 暂停对应的桶；带 coalesce_key 的消息入队后等待 OUTBOX_COALESCE_SECONDS，
+# 期间同键的新消息直接追加到这条消息中，连续发布的频道帖子只产生一条管理员通知。
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", 30))
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", 1))
+OUTBOX_CHAT_BURST = 3
+OUTBOX_COALESCE_SECONDS = float(os.environ.get("OUTBOX_COALESCE_MS", 2000)) / 1000
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_KEEP_DONE_SECONDS = 86400
+OUTBOX_CALLBACK_TTL = 15      # 回调应答超过此时间 Telegram 已不再接受，直接丢弃
+TELEGRAM_TEXT_LIMIT = 4096
+
+_outbox_wakeup = threading.Event()
+
+def enqueue_message(method, chat_id=None, coalesce_key=None, **params):
+    """把一次 Bot API 调用写入发送队列，由后台 dispatcher 发送
+    
+    Args:
+        method: TeleBot 方法名，如 send_message、edit_message_text、answer_callback_query
+        chat_id: 目标会话，用于按会话限速；answer_callback_query 等没有会话的调用为 None
+        coalesce_key: 合并键，同键且尚未发送的消息会把 text 追加到同一条消息中
+        **params: 方法参数，需可 JSON 序列化（reply_markup 传 to_json() 后的字符串）
+    """
+    now = time.time()
+    if chat_id is not None:
+        params['chat_id'] = chat_id
+    with get_db() as conn:
+        if coalesce_key:
+            merged = conn.execute("""UPDATE outbox SET params=json_set(params, '$.text', json_extract(params, '$.text') || char(10) || char(10) || ?),
+                                            updated_at=?
+                                     WHERE id=(SELECT id FROM outbox WHERE coalesce_key=? AND status='pending'
+                                               AND length(json_extract(params, '$.text')) + length(?) + 2 <= ?
+                                               ORDER BY id DESC LIMIT 1)""",
+                                  (params['text'], now, coalesce_key, params['text'], TELEGRAM_TEXT_LIMIT)).rowcount
+            if merged:
+                return
+        conn.execute("""INSERT INTO outbox (method, chat_id, params, coalesce_key, status, attempts, next_attempt_at, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, 'pending', 0, ?, ?, ?)""",
+                     (method, None if chat_id is None else str(chat_id), json.dumps(params, ensure_ascii=False), coalesce_key,
+                      now + OUTBOX_COALESCE_SECONDS if coalesce_key else now, now, now))
+    _outbox_wakeup.set()
+
+def notify_admin(text, coalesce_key=None, **params):
+    """给管理员发送一条文本消息（经发送队列）"""
+    enqueue_message('send_message', MY_CHAT_ID, coalesce_key=coalesce_key, text=text, **params)
+
+def claim_outbox_message():
+    """领取一条到期的消息，BEGIN IMMEDIATE 保证多进程下不会重复领取
+    
+    Returns:
+        sqlite3.Row: 没有到期消息时为 None
+    """
+    now = time.time()
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("""SELECT * FROM outbox
+                              WHERE (status='pending' AND next_attempt_at<=?)
+                                 OR (status='processing' AND updated_at<?)
+                              ORDER BY id LIMIT 1""", (now, now - OUTBOX_LEASE_SECONDS)).fetchone()
+        if row:
+            conn.execute("UPDATE outbox SET status='processing', attempts=attempts+1, updated_at=? WHERE id=?", (now, row['id']))
+    return row
+
+def finish_outbox_message(row, error=None, retry_in=None, permanent=False):
+    """记录发送结果
+    
+    Args:
+        row: claim_outbox_message() 返回的行
+        error: 失败原因，None 表示发送成功
+        retry_in: 限速或 retry_after 导致的推迟（秒），不计入失败次数
+        permanent: 不可重试的错误（如 400 / 403），直接标记为 failed
+    """
+    now = time.time()
+    with get_db() as conn:
+        if retry_in is not None:
+            conn.execute("UPDATE outbox SET status='pending', attempts=attempts-1, next_attempt_at=?, updated_at=? WHERE id=?",
+                         (now + retry_in, now, row['id']))
+            if row['chat_id']:
+                # 同一会话后面的消息一并顺延，避免逐条领取后再被限速
+                conn.execute("UPDATE outbox SET next_attempt_at=MAX(next_attempt_at, ?) WHERE chat_id=? AND status='pending' AND id>?",
+                             (now + retry_in, row['chat_id'], row['id']))
+        elif error is None:
+            conn.execute("UPDATE outbox SET status='done', last_error=NULL, updated_at=? WHERE id=?", (now, row['id']))
+        elif permanent or row['attempts'] + 1 >= OUTBOX_MAX_ATTEMPTS:
+            conn.execute("UPDATE outbox SET status='failed', last_error=?, updated_at=? WHERE id=?", (error, now, row['id']))
+        else:
+            delay = min(300, 5 * 2 ** row['attempts'])
+            conn.execute("UPDATE outbox SET status='pending', last_error=?, next_attempt_at=?, updated_at=? WHERE id=?",
+                         (error, now + delay, now, row['id']))
+
+def deliver_outbox_message(row):
+    """按速率限制发送一条消息，记录从入队到送达的延迟"""
+    if row['method'] == 'answer_callback_query' and time.time() - row['created_at'] > OUTBOX_CALLBACK_TTL:
+        return finish_outbox_message(row, error="expired", permanent=True)
+    
+    # 先检查会话额度再检查全局额度，任一不足都稍后重试
+    chat_limit = (f"tg_chat_{row['chat_id']}", OUTBOX_CHAT_BURST, OUTBOX_CHAT_BURST / OUTBOX_CHAT_RATE) if row['chat_id'] else None
+    global_limit = ("tg_global", OUTBOX_GLOBAL_RATE, 1)
+    if (chat_limit and not check_rate_limit(*chat_limit)) or not check_rate_limit(*global_limit):
+        metrics.inc('outbox_throttled_total')
+        return finish_outbox_message(row, retry_in=1 / OUTBOX_CHAT_RATE if chat_limit else 1 / OUTBOX_GLOBAL_RATE)
+    
+    ApiTelegramException = load_telebot().apihelper.ApiTelegramException
     try:
-        file_info = bot.get_file(media_obj.file_id)
-        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-        with requests.get(file_url, stream=True, timeout=30) as r:
-            if r.status_code == 200:
-                with open(target_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192): f.write(chunk)
-                
-                # 如果是视频，生成缩略图
-                if ext == ".mp4":
-                    thumb_name = f"{media_obj.file_id}_thumb.jpg"
-                    thumb_path = os.path.join(UPLOAD_DIR, thumb_name)
-                    if generate_video_thumbnail(target_path, thumb_path):
-                        thumbnail_path = f"/uploads/{thumb_name}"
+        getattr(bot, row['method'])(**json.loads(row['params']))
+    except ApiTelegramException as e:
+        if e.error_code == 429:
+            retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+            metrics.inc('outbox_retry_after_total')
+            pause_rate_limit(chat_limit[0] if chat_limit else global_limit[0], retry_after,
+                             *(chat_limit or global_limit)[1:])
+            return finish_outbox_message(row, retry_in=retry_after)
+        # 4xx（消息未修改、被用户屏蔽等）重试也不会成功
+        return finish_outbox_message(row, error=str(e)[:500], permanent=400 <= e.error_code < 500)
+    except Exception as e:
+        return finish_outbox_message(row, error=str(e)[:500])
+    finish_outbox_message(row)
+    metrics.observe('telegram_delivery_seconds', time.time() - row['created_at'], method=row['method'])
+
+def outbox_dispatcher():
+    """后台线程：循环领取并发送队列中的消息"""
+    last_cleanup = 0
+    while True:
+        try:
+            row = claim_outbox_message()
+        except sqlite3.Error as e:
+            print(f"Outbox error: {e}")
+            time.sleep(1)
+            continue
+        if not row:
+            if time.time() - last_cleanup > 3600:
+                with get_db() as conn:
+                    conn.execute("DELETE FROM outbox WHERE status='done' AND updated_at<?", (time.time() - OUTBOX_KEEP_DONE_SECONDS,))
+                last_cleanup = time.time()
+            _outbox_wakeup.wait(0.5)
+            _outbox_wakeup.clear()
+            continue
+        try:
+            deliver_outbox_message(row)
+        except Exception as e:
+            print(f"Outbox Error (message {row['id']}): {e}")
+
+def get_outbox_counts():
+    """发送队列各状态的消息数"""
+    with get_db() as conn:
+        counts = {r['status']: r['n'] for r in conn.execute("SELECT status, COUNT(*) as n FROM outbox GROUP BY status")}
+    return {k: counts.get(k, 0) for k in ('pending', 'processing', 'done', 'failed')}
+
+# --- 热门排序 ---
+# 点赞、评论、收藏、拉黑在各自的写事务中累加 hot_rank.score（权重 × hot_scale），热门页直接倒序扫描 idx_hot_rank_score。
+# hot_scale 每 HOT_SCALE_INTERVAL 秒按当前时间刷新一次，因此事件时间的精度为该间隔；距 hot_epoch 超过 HOT_REBASE_INTERVAL 时
+# 把全部分数除以 hot_scale 折算到当前时刻并重置基准（整体衰减），避免分数无限增长。
+# 刷新与折算都在 BEGIN IMMEDIATE 事务中读取 hot_epoch，多个 worker 同时执行时只会折算一次。
+HOT_SCALE_INTERVAL = 60
+HOT_REBASE_INTERVAL = 86400
+HOT_SCORE_SQL = """UPDATE hot_rank SET score = score + ? * (SELECT CAST(value AS REAL) FROM settings WHERE key='hot_scale')
+                   WHERE post_id=?"""
+# 热门页的分页查询：CROSS JOIN 固定以 hot_rank 的索引倒序扫描为外层循环，按游标 (score, post_id) 取下一段
+HOT_QUERY = """SELECT p.*, h.score AS hot_score FROM hot_rank h CROSS JOIN feed f ON f.post_id = h.post_id
+               CROSS JOIN posts p ON p.id = h.post_id
+               WHERE (h.score, h.post_id) < (?, ?) AND h.post_id NOT IN (SELECT post_id FROM user_blacklist WHERE user_id=?)
+               ORDER BY h.score DESC, h.post_id DESC LIMIT ? OFFSET ?"""
+
+def bump_hot_score(conn, post_id, event, count=1):
+    """在调用方的事务中按事件权重累加帖子热度
+    
+    Args:
+        conn: 数据库连接
+        post_id: 帖子 ID
+        event: HOT_WEIGHTS 中的事件名
+        count: 事件次数，负数表示撤销（取消收藏、删除评论）
+    """
+    conn.execute(HOT_SCORE_SQL, (HOT_WEIGHTS[event] * count, post_id))
+
+def decay_hot_scores():
+    """按当前时间刷新 hot_scale，距 hot_epoch 超过 HOT_REBASE_INTERVAL 时整体折算全部分数
+    
+    Returns:
+        float: 刷新后的 hot_scale
+    """
+    now = time.time()
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        epoch = float(conn.execute("SELECT value FROM settings WHERE key='hot_epoch'").fetchone()['value'])
+        scale = 2 ** ((now - epoch) / HOT_HALF_LIFE)
+        if now - epoch >= HOT_REBASE_INTERVAL:
+            with timed('hot_rank_rebase_seconds'):
+                conn.execute("UPDATE hot_rank SET score = score / ?", (scale,))
+            epoch, scale = now, 1.0
+        conn.executemany("UPDATE settings SET value=? WHERE key=?", [(repr(epoch), 'hot_epoch'), (repr(scale), 'hot_scale')])
+    return scale
+
+def hot_rank_decayer():
+    """后台线程：每 HOT_SCALE_INTERVAL 秒刷新一次 hot_scale"""
+    while True:
+        try:
+            decay_hot_scores()
+        except Exception as e:
+            print(f"Hot rank decay error: {e}")
+        time.sleep(HOT_SCALE_INTERVAL)
+
+def fetch_hot_page(conn, user_id, cursor=None, limit=20, offset=0):
+    """按热度倒序取一页 feed
+    
+    Args:
+        conn: 数据库连接
+        user_id: 当前用户，排除其拉黑的帖子
+        cursor: 上一页 hot_cursor() 的解码结果 [score, post_id, epoch]，None 表示从最热的一条开始
+        limit: 条数
+        offset: 跳过的条数（兼容 ?page=N 链接）
+    
+    Returns:
+        tuple: (帖子行列表, 当前 hot_epoch)，行内带 hot_score 字段
+    """
+    epoch = float(conn.execute("SELECT value FROM settings WHERE key='hot_epoch'").fetchone()['value'])
+    if cursor is None:
+        score, post_id = float('inf'), 0
+    else:
+        score, post_id, cursor_epoch = cursor
+        # 游标生成后发生过整体折算：把游标分数换算到当前基准（指数限制在浮点范围内，伪造或过旧的游标不会溢出）
+        score /= 2 ** max(min((epoch - cursor_epoch) / HOT_HALF_LIFE, 1000), -1000)
+    return conn.execute(HOT_QUERY, (score, post_id, user_id, limit, offset)).fetchall(), epoch
+
+def hot_cursor(row, epoch):
+    """热门页下一页的游标：最后一条的分数、ID 与生成时的 hot_epoch"""
+    return encode_cursor(row['hot_score'], row['id'], epoch)
+
+def is_hot_cursor(values):
+    """decode_cursor() 的结果是否为合法的热门页游标"""
+    return (values is not None and len(values) == 3
+            and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values))
+
+# --- 点赞写回缓冲 ---
+# 点赞先累加在进程内存中，由后台线程按时间或数量批量写入 posts.likes，
+# 避免热门帖子下每次点击都单独争抢 SQLite 写锁。进程退出时（atexit）会再写一次。
+LIKE_FLUSH_INTERVAL = float(os.environ.get("LIKE_FLUSH_INTERVAL_MS", 500)) / 1000
+LIKE_FLUSH_BATCH = int(os.environ.get("LIKE_FLUSH_BATCH", 200))
+
+_pending_likes = defaultdict(int)
+_likes_lock = threading.Lock()
+_likes_flush_event = threading.Event()
+like_stats = {'buffered': 0, 'flushed': 0, 'flushes': 0, 'flush_errors': 0}
+
+def record_like(post_id):
+    """记录一次点赞，攒够 LIKE_FLUSH_BATCH 次时唤醒写回线程"""
+    with _likes_lock:
+        _pending_likes[post_id] += 1
+        like_stats['buffered'] += 1
+        pending = like_stats['buffered'] - like_stats['flushed']
+    if pending >= LIKE_FLUSH_BATCH:
+        _likes_flush_event.set()
+
+def get_pending_likes(post_id):
+    """当前进程中尚未写入数据库的点赞数"""
+    with _likes_lock:
+        return _pending_likes.get(post_id, 0)
+
+def flush_likes():
+    """把缓冲的点赞在一个事务中写入数据库，失败时放回缓冲等待下次重试
+    
+    Returns:
+        int: 本次写入的点赞数
+    """
+    with _likes_lock:
+        if not _pending_likes:
+            return 0
+        batch = dict(_pending_likes)
+        _pending_likes.clear()
+    try:
+        with get_db() as conn:
+            conn.executemany("UPDATE posts SET likes=likes+? WHERE id=?", [(n, pid) for pid, n in batch.items()])
+            conn.executemany(HOT_SCORE_SQL, [(n * HOT_WEIGHTS['like'], pid) for pid, n in batch.items()])
+    except Exception:
+        with _likes_lock:
+            for pid, n in batch.items():
+                _pending_likes[pid] += n
+            like_stats['flush_errors'] += 1
+        raise
+    total = sum(batch.values())
+    with _likes_lock:
+        like_stats['flushed'] += total
+        like_stats['flushes'] += 1
+    return total
+
+def like_flusher():
+    """后台线程：每 LIKE_FLUSH_INTERVAL 秒或被唤醒时写回一次"""
+    while True:
+        _likes_flush_event.wait(LIKE_FLUSH_INTERVAL)
+        _likes_flush_event.clear()
+        try:
+            flush_likes()
+        except Exception as e:
+            print(f"Like flush error: {e}")
+
+atexit.register(flush_likes)
+
+# --- 频道回填 ---
+# Bot API 没有读取频道历史的接口（telebot 也没有 get_chat_history），
+# 因此按消息 ID 逐页转发到管理员会话读取内容，再删除转发副本。
+# 转发和删除与发送队列共用管理员会话和全局的令牌桶；连续 429 的消息记为 throttled，
+# 与下载失败的消息一起写入重试列表（settings.sync_retry），下次 /sync 先重试这些消息，断点照常推进。
+SYNC_PAGE_SIZE = int(os.environ.get("SYNC_PAGE_SIZE", 50))
+SYNC_WORKERS = int(os.environ.get("SYNC_WORKERS", 4))
+SYNC_MAX_EMPTY_PAGES = 3      # 超过已知最新消息后连续多少个空页视为到达末尾
+SYNC_LEASE_SECONDS = 300      # 回填锁租期，进程崩溃后可被其他 worker 接管
+SYNC_MAX_RETRIES = 5          # 同一条消息最多重试的同步次数，超过后放弃
+
+class SyncThrottled(Exception):
+    """读取历史消息时连续收到 429"""
+
+class SyncUnavailable(Exception):
+    """读取历史消息时 Telegram 返回 5xx，稍后重试可能成功"""
+
+# 转发不存在或已删除的消息时 Bot API 返回的 400 错误描述
+SYNC_MISSING_ERRORS = ('message to forward not found', 'message not found')
+
+def wait_telegram_quota(chat_id):
+    """阻塞直到会话和全局令牌桶都有额度（与发送队列使用相同的桶）
+    
+    Returns:
+        tuple: (会话桶参数, 全局桶参数)，收到 429 时传给 pause_rate_limit
+    """
+    chat_limit = (f"tg_chat_{chat_id}", OUTBOX_CHAT_BURST, OUTBOX_CHAT_BURST / OUTBOX_CHAT_RATE)
+    global_limit = ("tg_global", OUTBOX_GLOBAL_RATE, 1)
+    while not check_rate_limit(*chat_limit):
+        time.sleep(1 / OUTBOX_CHAT_RATE)
+    while not check_rate_limit(*global_limit):
+        time.sleep(1 / OUTBOX_GLOBAL_RATE)
+    return chat_limit, global_limit
+
+def fetch_channel_message(msg_id):
+    """读取频道中的一条历史消息，不存在时返回 None
+    
+    Raises:
+        SyncThrottled: 连续 3 次收到 429
+        SyncUnavailable: Telegram 返回 5xx
+        ApiTelegramException: 其他错误（机器人被移出频道、CHANNEL_ID 错误等），重试也不会成功，回填中止
+    """
+    ApiTelegramException = load_telebot().apihelper.ApiTelegramException
+    for _ in range(3):
+        chat_limit, _ = wait_telegram_quota(MY_CHAT_ID)
+        try:
+            m = bot.forward_message(MY_CHAT_ID, CHANNEL_ID, msg_id, disable_notification=True)
+            break
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                # 暂停会话桶，其他回填线程和发送队列也一起等待
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 5)
+                pause_rate_limit(chat_limit[0], retry_after, *chat_limit[1:])
+                time.sleep(retry_after)
+                continue
+            if e.error_code == 400 and any(text in e.description.lower() for text in SYNC_MISSING_ERRORS):
+                return None  # 消息不存在或已被删除
+            if e.error_code >= 500:
+                raise SyncUnavailable(f"message #{msg_id}: {e.description}") from e
+            raise
+    else:
+        raise SyncThrottled(f"message #{msg_id} throttled")
+    if not m:
+        return None
+    wait_telegram_quota(MY_CHAT_ID)
+    try: bot.delete_message(MY_CHAT_ID, m.message_id)
+    except Exception: pass
+    origin = getattr(m, 'forward_origin', None)
+    m.date = getattr(origin, 'date', None) or m.date
+    m.message_id = msg_id  # 使用频道中的原始消息 ID
+    return m
+
+def backfill_message(msg_id):
+    """读取并下载一条历史消息
+    
+    Returns:
+        tuple: (状态, 入库参数)，状态为 'missing' / 'skipped' / 'throttled' / 'failed' / 'ok'
+    """
+    try:
+        h = fetch_channel_message(msg_id)
+    except SyncThrottled:
+        return 'throttled', None
+    except SyncUnavailable:
+        return 'failed', None  # 进入重试列表
+    if not h:
+        return 'missing', None
+    if not (h.photo or h.video):
+        return 'skipped', None
+    try:
+        path, thumbnail = download_media(h)
+    except MediaTooLarge:
+        return 'skipped', None  # 超过下载上限，重试也不会成功
+    if not path:
+        return 'failed', None
+    date = datetime.fromtimestamp(h.date).strftime("%Y-%m-%d") if h.date else datetime.now().strftime("%Y-%m-%d")
+    return 'ok', (h.message_id, (h.text or h.caption or ""), date, h.media_group_id, path, thumbnail)
+
+def acquire_sync_lease():
+    """跨进程互斥：同一时间只允许一个回填任务运行"""
+    now = time.time()
+    with get_db() as conn:
+        conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('sync_lease', '0')")
+        return conn.execute("UPDATE settings SET value=? WHERE key='sync_lease' AND CAST(value AS REAL)<?",
+                            (str(now + SYNC_LEASE_SECONDS), now)).rowcount == 1
+
+def release_sync_lease():
+    with get_db() as conn:
+        conn.execute("UPDATE settings SET value='0' WHERE key='sync_lease'")
+
+def run_channel_backfill(reset=False):
+    """先重试上次失败 / 被限流的消息，再从断点开始分页回填频道历史，并发下载媒体，每页一个事务写入，进度汇报给管理员"""
+    if not acquire_sync_lease():
+        notify_admin("⚠️ 已有同步任务在运行")
+        return
+    try:
+        with get_db() as conn:
+            if reset:
+                conn.execute("DELETE FROM settings WHERE key IN ('sync_checkpoint', 'sync_retry')")
+            row = conn.execute("SELECT value FROM settings WHERE key='sync_checkpoint'").fetchone()
+            checkpoint = int(row['value']) if row else 0
+            row = conn.execute("SELECT value FROM settings WHERE key='sync_retry'").fetchone()
+            retry = {int(k): v for k, v in json.loads(row['value']).items()} if row else {}  # 消息 ID -> 已失败次数
+            latest = conn.execute("SELECT MAX(msg_id) as m FROM posts WHERE title='官方'").fetchone()['m'] or 0
+        
+        # 进度消息需要 message_id 供后续编辑，不经发送队列
+        progress = bot.send_message(MY_CHAT_ID, f"🔄 正在同步频道（重试 {len(retry)} 条，从消息 #{checkpoint + 1} 开始）...")
+        started = time.time()
+        stats = defaultdict(int)
+        
+        def settle(ids, results):
+            """统计一批结果、更新重试列表，并在一个事务中入库、保存断点和重试列表"""
+            for i, (status, _) in zip(ids, results):
+                stats[status] += 1
+                if status in ('throttled', 'failed'):
+                    retry[i] = retry.get(i, 0) + 1
+                    if retry[i] >= SYNC_MAX_RETRIES:
+                        del retry[i]
+                        stats['abandoned'] += 1
+                else:
+                    retry.pop(i, None)
+            rows = [r for status, r in results if status == 'ok']
+            # 同一页内的相册条目合并为一条帖子，跨页的条目由 save_post 追加到已有帖子
+            albums = defaultdict(list)
+            for row in rows:
+                albums[row[3] or f"P{row[0]}"].append(row)
+            with get_db() as conn:
+                for items in albums.values():
+                    msg_id, _, date, gid, _, _ = items[0]
+                    save_post(conn, [(m, text, path, thumb) for m, text, _, _, path, thumb in items], gid, "官方", date, 1)
+                conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('sync_checkpoint', ?)", (str(checkpoint),))
+                conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('sync_retry', ?)", (json.dumps(retry),))
+                conn.execute("UPDATE settings SET value=? WHERE key='sync_lease'", (str(time.time() + SYNC_LEASE_SECONDS),))
+            if rows:
+                invalidate_cache('feed')
+        
+        def report(position):
+            elapsed = time.time() - started
+            msg = (f"🔄 同步中... {position}\n"
+                   f"入库 {stats['ok']} | 无媒体 {stats['skipped']} | 失败 {stats['failed']} | 限流 {stats['throttled']} | 不存在 {stats['missing']}\n"
+                   f"速度 扫描 {sum(stats[k] for k in ('ok', 'skipped', 'failed', 'throttled', 'missing')) / elapsed:.1f} 条/秒，"
+                   f"入库 {stats['ok'] / elapsed:.1f} 条/秒")
+            if progress:
+                try: bot.edit_message_text(msg, MY_CHAT_ID, progress.message_id)
+                except Exception: pass
+        
+        empty_pages = 0
+        start = checkpoint + 1
+        with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as pool:
+            pending = sorted(retry)
+            for n in range(0, len(pending), SYNC_PAGE_SIZE):
+                ids = pending[n:n + SYNC_PAGE_SIZE]
+                settle(ids, list(pool.map(backfill_message, ids)))
+                report(f"已重试 {n + len(ids)}/{len(pending)} 条")
+            
+            while empty_pages < SYNC_MAX_EMPTY_PAGES:
+                ids = list(range(start, start + SYNC_PAGE_SIZE))
+                results = list(pool.map(backfill_message, ids))
+                # 限流和下载失败的消息可能存在，计入 found 并进入重试列表，断点可以越过它们
+                found = [i for i, (status, _) in zip(ids, results) if status != 'missing']
+                # 断点只推进到已知存在的消息，末尾的空页不计入，避免跳过之后发布的消息
+                if found or ids[-1] <= latest:
+                    checkpoint = ids[-1] if ids[-1] <= latest else found[-1]
+                settle(ids, results)
                 
-                return f"/uploads/{save_name}", thumbnail_path
+                empty_pages = empty_pages + 1 if (not found and ids[-1] > latest) else 0
+                start = ids[-1] + 1
+                report(f"已扫描至 #{ids[-1]}")
+        
+        elapsed = time.time() - started
+        notify_admin(f"✅ 同步完成，耗时 {elapsed:.0f}s\n入库 {stats['ok']} 条，失败 {stats['failed']} 条，限流 {stats['throttled']} 条，"
+                     f"待重试 {len(retry)} 条，放弃 {stats['abandoned']} 条，断点 #{checkpoint}")
     except Exception as e:
-        print(f"Download Error: {e}")
-    return None, None
+        print(f"Sync Error: {e}")
+        notify_admin(f"❌ 同步中断：{e}\n再次发送 /sync 将从断点继续")
+    finally:
+        release_sync_lease()
 
-@app.route('/uploads/<path:filename>')
-def serve_uploads(filename):
-    return send_from_directory(UPLOAD_DIR, filename)
+# --- 后台线程 ---
+_workers_lock = threading.Lock()
+_workers_pid = None
+
+def start_background_workers():
+    """在当前进程中启动后台线程（gunicorn fork 之后每个 worker 各自启动一次）"""
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        for i in range(INGEST_WORKERS):
+            threading.Thread(target=ingest_worker, name=f"ingest-{i}", daemon=True).start()
+        threading.Thread(target=like_flusher, name="like-flusher", daemon=True).start()
+        threading.Thread(target=outbox_dispatcher, name="outbox-dispatcher", daemon=True).start()
+        threading.Thread(target=hot_rank_decayer, name="hot-rank-decayer", daemon=True).start()
+        if HLS_ENABLED:
+            threading.Thread(target=hls_worker, name="hls-segmenter", daemon=True).start()
+        if PROFILE_SLOW_MS > 0:
+            threading.Thread(target=profile_sampler, name="profile-sampler", daemon=True).start()
+        _workers_pid = os.getpid()
+
+@app.before_request
+def ensure_background_workers():
+    start_background_workers()
 
 # --- Webhook 逻辑 ---
 @app.route('/webhook', methods=['POST'])
 def webhook():
     if request.headers.get('content-type') == 'application/json':
         json_string = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
+        update = load_telebot().types.Update.de_json(json_string)
         
         # 1. 审核回调
         if update.callback_query:
             try:
                 action, target = update.callback_query.data.split('_', 1)
                 with get_db() as conn:
+                    # 旧版本的相册审核按钮携带 G<media_group_id>
+                    if target.startswith('G'):
+                        affected = [r['id'] for r in conn.execute("SELECT id FROM posts WHERE media_group_id=?", (target[1:],))]
+                    else:
+                        affected = [int(target)]
+                    marks = ','.join('?' * len(affected))
                     if action == 'y':
-                        sql = "UPDATE posts SET is_approved=1 WHERE " + ("media_group_id=?" if target.startswith('G') else "id=?")
-                        conn.execute(sql, (target[1:] if target.startswith('G') else target,))
-                        bot.answer_callback_query(update.callback_query.id, "审核通过")
+                        conn.execute(f"UPDATE posts SET is_approved=1 WHERE id IN ({marks})", affected)
+                        answer = "审核通过"
                     else:
-                        sql = "DELETE FROM posts WHERE " + ("media_group_id=?" if target.startswith('G') else "id=?")
-                        conn.execute(sql, (target[1:] if target.startswith('G') else target,))
-                        bot.answer_callback_query(update.callback_query.id, "已拒绝并删除")
-                bot.edit_message_caption("【审核操作已完成】", MY_CHAT_ID, update.callback_query.message.message_id)
+                        conn.execute(f"DELETE FROM posts WHERE id IN ({marks})", affected)
+                        answer = "已拒绝并删除"
+                invalidate_cache('feed', *post_namespaces(affected))
+                enqueue_message('answer_callback_query', callback_query_id=update.callback_query.id, text=answer)
+                # 审核提醒是文本消息（旧版本为带图消息），按类型编辑，同时移除按钮
+                message = update.callback_query.message
+                if message.content_type == 'text':
+                    enqueue_message('edit_message_text', MY_CHAT_ID, text=f"{message.text}\n\n【审核操作已完成：{answer}】",
+                                    message_id=message.message_id)
+                else:
+                    enqueue_message('edit_message_caption', MY_CHAT_ID, caption="【审核操作已完成】", message_id=message.message_id)
             except: pass
             return 'OK'
 
@@ -252,7 +2555,6 @@ def webhook():
         
         uid = p.from_user.id if p.from_user else None
         txt = p.text or p.caption or ""
-        gid = p.media_group_id
 
         # 2. 管理员指令
         if str(uid) == str(MY_CHAT_ID) or str(p.chat.id) == str(MY_CHAT_ID):
@@ -267,9 +2569,9 @@ def webhook():
                         preview = (p_row['text'] or '无内容')[:25] + '...' if p_row['text'] and len(p_row['text']) > 25 else (p_row['text'] or '无内容')
                         admin_url = f"{BASE_URL}/post/{p_row['id']}?admin_key={ADMIN_KEY}"
                         msg += f"[{p_row['id']}] {preview}\n{admin_url}\n\n"
-                    bot.send_message(MY_CHAT_ID, msg, parse_mode='Markdown', disable_web_page_preview=True)
+                    notify_admin(msg, parse_mode='Markdown', disable_web_page_preview=True)
                 else:
-                    bot.send_message(MY_CHAT_ID, "暂无帖子")
+                    notify_admin("暂无帖子")
                 return 'OK'
             
             # /admin <id> - 获取指定帖子管理员链接
@@ -282,16 +2584,17 @@ def webhook():
                     if post:
                         admin_url = f"{BASE_URL}/post/{post['id']}?admin_key={ADMIN_KEY}"
                         msg = f"🔧 帖子 #{post['id']} 管理员链接\n\n🔗 {admin_url}"
-                        bot.send_message(MY_CHAT_ID, msg, disable_web_page_preview=True)
+                        notify_admin(msg, disable_web_page_preview=True)
                     else:
-                        bot.send_message(MY_CHAT_ID, f"❌ 帖子 #{post_id} 不存在")
+                        notify_admin(f"❌ 帖子 #{post_id} 不存在")
                 except ValueError:
-                    bot.send_message(MY_CHAT_ID, "❌ 格式错误，请使用: /admin <帖子ID>")
+                    notify_admin("❌ 格式错误，请使用: /admin <帖子ID>")
                 return 'OK'
             
             if txt.startswith('/notice '):
                 with get_db() as conn: conn.execute("UPDATE settings SET value=? WHERE key='notice'", (txt[8:],))
-                bot.send_message(MY_CHAT_ID, "✅ 公告已更新")
+                invalidate_cache('notice', 'feed', 'user')
+                notify_admin("✅ 公告已更新")
                 return 'OK'
             
             if txt.startswith('/desc '):
@@ -301,84 +2604,294 @@ def webhook():
                     post_id, desc = parts
                     with get_db() as conn: 
                         conn.execute("UPDATE posts SET custom_description=? WHERE id=?", (desc, int(post_id)))
-                    bot.send_message(MY_CHAT_ID, f"✅ 已为帖子 {post_id} 设置自定义描述")
+                    invalidate_cache('feed', f"post:{int(post_id)}")
+                    notify_admin(f"✅ 已为帖子 {post_id} 设置自定义描述")
                 else:
-                    bot.send_message(MY_CHAT_ID, "❌ 格式错误，请使用: /desc <post_id> <描述文字>")
+                    notify_admin("❌ 格式错误，请使用: /desc <post_id> <描述文字>")
+                return 'OK'
+            
+            # /queue - 查看入库队列状态，/queue retry - 重新排队失败任务
+            if txt == '/queue':
+                status = get_ingest_status()
+                c = status['counts']
+                msg = f"📥 入库队列\n\n等待: {c['pending']}\n处理中: {c['processing']}\n完成: {c['done']}\n失败: {c['failed']}\n最久等待: {status['oldest_pending_seconds']}s"
+                for f in status['recent_failures'][:5]:
+                    msg += f"\n\n#{f['id']} ({f['attempts']}次): {f['last_error']}"
+                notify_admin(msg)
+                return 'OK'
+            
+            if txt == '/queue retry':
+                with get_db() as conn:
+                    n = conn.execute("UPDATE ingest_queue SET status='pending', attempts=0, next_attempt_at=0 WHERE status='failed'").rowcount
+                _ingest_wakeup.set()
+                notify_admin(f"✅ 已重新排队 {n} 个失败任务")
                 return 'OK'
             
-            if txt == '/sync':
-                bot.send_message(MY_CHAT_ID, "🔄 正在同步频道...")
-                history = bot.get_chat_history(CHANNEL_ID, limit=50)
-                for h in history:
-                    path, thumbnail = download_media(h)
-                    if path:
-                        with get_db() as conn:
-                            conn.execute("INSERT OR IGNORE INTO posts (msg_id, text, title, date, media_group_id, first_media, thumbnail, is_approved) VALUES (?,?,?,?,?,?,?,1)",
-                                         (h.message_id, (h.text or h.caption or ""), "官方", datetime.now().strftime("%Y-%m-%d"), h.media_group_id, path, thumbnail))
-                bot.send_message(MY_CHAT_ID, "✅ 同步完成")
+            # /gc - 回收不再被引用的媒体文件
+            if txt == '/gc':
+                def run_gc():
+                    freed = collect_media_garbage()
+                    notify_admin(f"🧹 已回收 {freed['files']} 个文件，释放 {format_bytes(freed['bytes'])}")
+                threading.Thread(target=run_gc, daemon=True).start()
                 return 'OK'
+            
+            # /sync - 从断点继续回填频道历史，/sync reset - 从头开始
+            if txt in ('/sync', '/sync reset'):
+                threading.Thread(target=run_channel_backfill, args=(txt == '/sync reset',), daemon=True).start()
+                return 'OK'
+
+        # 3. 投稿频率限制（超限直接丢弃，仍返回 OK 以免 Telegram 重发）
+        if uid and not check_rate_limit(f'webhook_{uid}', max_requests=20, window_seconds=60):
+            return 'OK'
 
-        # 3. 黑名单拦截
+        # 4. 黑名单拦截
         if uid:
             with get_db() as conn:
                 if conn.execute("SELECT 1 FROM blacklist WHERE user_id=?", (uid,)).fetchone(): return 'OK'
 
-        # 4. 入库处理
-        path, thumbnail = download_media(p)
-        if path:
-            if (update.edited_channel_post or update.edited_message):
-                with get_db() as conn: conn.execute("UPDATE posts SET text=?, first_media=?, thumbnail=? WHERE msg_id=?", (txt, path, thumbnail, p.message_id))
-            else:
-                with get_db() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("INSERT OR IGNORE INTO posts (msg_id, text, title, date, media_group_id, first_media, thumbnail, is_approved, user_id) VALUES (?,?,?,?,?,?,?,?,?)",
-                                   (p.message_id, txt, "官方" if update.channel_post else "投稿", datetime.now().strftime("%Y-%m-%d"), gid, path, thumbnail, 1 if update.channel_post else 0, uid))
-                    new_id = cursor.lastrowid
-                
-                # 5. 投稿审核提醒
-                if not update.channel_post and str(uid) != str(MY_CHAT_ID):
-                    markup = InlineKeyboardMarkup().row(
-                        InlineKeyboardButton("✅通过", callback_data=f"y_{'G'+gid if gid else new_id}"),
-                        InlineKeyboardButton("❌拒绝", callback_data=f"n_{'G'+gid if gid else new_id}")
-                    )
-                    bot.send_message(MY_CHAT_ID, f"🔔 新投稿:\n{txt[:100]}", reply_markup=markup)
-                
-                # 6. 发送管理员链接
-                if update.channel_post and new_id:
-                    admin_url = f"{BASE_URL}/post/{new_id}?admin_key={ADMIN_KEY}"
-                    bot.send_message(MY_CHAT_ID, f"📢 新帖子已发布！\n\n🔗 管理链接：{admin_url}")
+        # 5. 入库处理：写入队列后立即返回，下载/缩略图/入库由后台 worker 完成
+        if p.photo or p.video:
+            is_edit = update.edited_channel_post or update.edited_message
+            enqueue_ingest(json_string, group_key=None if is_edit else p.media_group_id)
         
         return 'OK'
     return 'OK'
 
 # --- 路由渲染 ---
+FEED_PAGE_SIZE = 20
+FEED_PREVIEW_CHARS = 200
+COMMENT_PAGE_SIZE = 20
+# 首页 feed 的游标分页查询，{cond} 为 f.post_id 的范围条件
+FEED_QUERY = """SELECT p.* FROM feed f JOIN posts p ON p.id = f.post_id
+                WHERE {cond} AND f.post_id NOT IN (SELECT post_id FROM user_blacklist WHERE user_id=?)
+                ORDER BY f.post_id {order} LIMIT ?"""
+
+SQLITE_INT_MIN, SQLITE_INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+def sqlite_int(value):
+    """解析整数参数，超出 SQLite 64 位整数范围时抛出 ValueError（request.args.get(type=...) 随之返回默认值）"""
+    n = int(value)
+    if not SQLITE_INT_MIN <= n <= SQLITE_INT_MAX:
+        raise ValueError(f"{value} out of range")
+    return n
+
+def encode_cursor(*values):
+    """把游标值编码为不透明的 URL 安全字符串"""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """解析 encode_cursor 生成的游标
+    
+    Returns:
+        list: 游标值，格式错误、整数超出 SQLite 64 位范围或浮点数非有限值时返回 None
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or not values:
+        return None
+    for v in values:
+        if isinstance(v, int) and not SQLITE_INT_MIN <= v <= SQLITE_INT_MAX:
+            return None
+        if isinstance(v, float) and not abs(v) < float('inf'):
+            return None
+    return values
+
 @app.route('/')
 def index():
     q = request.args.get('q', '')
     user_id = request.args.get('user_id', 'anonymous')
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
+    sort = 'hot' if request.args.get('sort') == 'hot' else 'new'
+    page = min(max(request.args.get('page', 1, type=sqlite_int), 1), SQLITE_INT_MAX // FEED_PAGE_SIZE)
+    # 超出范围的游标按未提供处理，返回第一页
+    before = request.args.get('before', type=sqlite_int)
+    after = request.args.get('after', type=sqlite_int)
+    cursor = request.args.get('cursor', '')
+    per_page = FEED_PAGE_SIZE
     offset = (page - 1) * per_page
+    has_next = False
+    prev_cursor = next_cursor = feed_cursor = None
+    
+    # 匿名访问的页面整页缓存
+    cache_key = ('feed', 'index', q, sort, page, before, after, cursor) if user_id == 'anonymous' else None
+    if cache_key:
+        cached = cache_get(cache_key)
+        if cached is not None:
+            return cached
     
+    notice = get_notice()
     with get_db() as conn:
-        notice = conn.execute("SELECT value FROM settings WHERE key='notice'").fetchone()
-        # 分组查询：如果是媒体组只显示一张，排除用户拉黑的内容
-        sql = """SELECT p.* FROM posts p 
-                 WHERE p.is_approved=1 AND p.text LIKE ? 
-                 AND p.id NOT IN (SELECT post_id FROM user_blacklist WHERE user_id=?)
-                 GROUP BY COALESCE(p.media_group_id, p.id) 
-                 ORDER BY p.id DESC
-                 LIMIT ? OFFSET ?"""
-        posts = conn.execute(sql, (f'%{q}%', user_id, per_page, offset)).fetchall()
+        match = build_fts_query(q) if q else None
+        if match:
+            # 全文检索：按 bm25 相关度排序。CROSS JOIN 固定以 FTS 结果为外层循环，
+            # 否则查询规划器可能改为逐行扫描 posts、每行单独做一次 MATCH
+            sql = """WITH m AS (SELECT rowid, rank FROM posts_fts WHERE posts_fts MATCH ?)
+                     SELECT p.*, m.rank as relevance FROM m CROSS JOIN posts p ON p.id = m.rowid
+                     WHERE p.is_approved=1
+                     AND p.id NOT IN (SELECT post_id FROM user_blacklist WHERE user_id=?)
+                     ORDER BY relevance, p.id DESC
+                     LIMIT ? OFFSET ?"""
+            posts = conn.execute(sql, (match, user_id, per_page, offset)).fetchall()
+            count_sql = """WITH m AS (SELECT rowid FROM posts_fts WHERE posts_fts MATCH ?)
+                           SELECT COUNT(*) as total FROM m CROSS JOIN posts p ON p.id = m.rowid
+                           WHERE p.is_approved=1
+                           AND p.id NOT IN (SELECT post_id FROM user_blacklist WHERE user_id=?)"""
+            total = conn.execute(count_sql, (match, user_id)).fetchone()['total']
+        elif q:
+            # 短搜索词（或 FTS5 不可用）：LIKE 查询
+            like = f'%{q}%'
+            sql = """SELECT p.* FROM posts p 
+                     WHERE p.is_approved=1 AND (p.text LIKE ? OR p.custom_description LIKE ?)
+                     AND p.id NOT IN (SELECT post_id FROM user_blacklist WHERE user_id=?)
+                     ORDER BY p.id DESC
+                     LIMIT ? OFFSET ?"""
+            posts = conn.execute(sql, (like, like, user_id, per_page, offset)).fetchall()
+            
+            # 获取总数用于分页
+            count_sql = """SELECT COUNT(*) as total FROM posts p 
+                           WHERE p.is_approved=1 AND (p.text LIKE ? OR p.custom_description LIKE ?)
+                           AND p.id NOT IN (SELECT post_id FROM user_blacklist WHERE user_id=?)"""
+            total = conn.execute(count_sql, (like, like, user_id)).fetchone()['total']
+        elif sort == 'hot':
+            # 热门：在 hot_rank 的分数索引上做游标分页；没有游标的 ?page=N 链接退回 OFFSET
+            hot = decode_cursor(cursor) if cursor else None
+            rows, epoch = fetch_hot_page(conn, user_id, hot if is_hot_cursor(hot) else None, per_page + 1,
+                                         0 if is_hot_cursor(hot) else offset)
+            posts, has_next = rows[:per_page], len(rows) > per_page
+            if has_next:
+                feed_cursor = hot_cursor(posts[-1], epoch)
+        else:
+            # 无搜索词：在 feed 表上做游标分页，第 N 页与第 1 页一样只需一次主键范围扫描
+            base = FEED_QUERY
+            if after is not None:
+                rows = conn.execute(base.format(cond="f.post_id > ?", order="ASC"), (after, user_id, per_page + 1)).fetchall()
+                posts = list(reversed(rows[:per_page]))
+                has_next = True
+            elif before is not None or page == 1:
+                rows = conn.execute(base.format(cond="f.post_id < ?", order="DESC"),
+                                    (before if before is not None else 2 ** 63 - 1, user_id, per_page + 1)).fetchall()
+                posts, has_next = rows[:per_page], len(rows) > per_page
+            else:
+                # 兼容旧的 ?page=N 链接
+                rows = conn.execute(base.format(cond="1", order="DESC") + " OFFSET ?", (user_id, per_page + 1, offset)).fetchall()
+                posts, has_next = rows[:per_page], len(rows) > per_page
+            if posts:
+                prev_cursor, next_cursor = posts[0]['id'], posts[-1]['id']
+            if has_next and next_cursor:
+                feed_cursor = encode_cursor(next_cursor)
         
-        # 获取总数用于分页
-        count_sql = """SELECT COUNT(DISTINCT COALESCE(p.media_group_id, p.id)) as total FROM posts p 
-                       WHERE p.is_approved=1 AND p.text LIKE ? 
-                       AND p.id NOT IN (SELECT post_id FROM user_blacklist WHERE user_id=?)"""
-        total = conn.execute(count_sql, (f'%{q}%', user_id)).fetchone()['total']
+        if q:
+            has_next = page * per_page < total
+        else:
+            feed_total = conn.execute("SELECT value FROM counters WHERE name='feed'").fetchone()['value']
+            hidden = conn.execute("SELECT COUNT(*) as n FROM user_blacklist b JOIN feed f ON f.post_id = b.post_id WHERE b.user_id=?", (user_id,)).fetchone()['n']
+            total = feed_total - hidden
         
-    return render_template('index.html', posts=posts, notice=notice['value'] if notice else "", 
-                         q=q, user_id=user_id, page=page, total_pages=(total + per_page - 1) // per_page)
+    html_page = render_template('index.html', posts=posts, notice=notice, 
+                                q=q, user_id=user_id, sort=sort, page=page, total_pages=max((total + per_page - 1) // per_page, page),
+                                has_next=has_next, prev_cursor=prev_cursor, next_cursor=next_cursor, feed_cursor=feed_cursor)
+    if cache_key:
+        page_cache.set(cache_key, html_page)
+    return html_page
+
+@app.route('/api/feed')
+def api_feed():
+    """首页 feed 的 JSON 分页接口（供无限滚动使用）
+    
+    参数 cursor 为上一页返回的 next_cursor，省略时从第一条开始；sort=hot 按热度排序，默认按发布时间。
+    响应带 ETag，客户端携带 If-None-Match 且内容未变化时返回 304。
+    """
+    user_id = request.args.get('user_id', 'anonymous')
+    sort = 'hot' if request.args.get('sort') == 'hot' else 'new'
+    token = request.args.get('cursor', '')
+    limit = min(max(request.args.get('limit', FEED_PAGE_SIZE, type=int), 1), 50)
+    cursor = decode_cursor(token) if token else None
+    if token and (not is_hot_cursor(cursor) if sort == 'hot' else (cursor is None or not isinstance(cursor[0], int))):
+        return jsonify({"status":"error", "message":"无效的游标"}), 400
+    
+    cache_key = ('feed', 'api', sort, token, limit) if user_id == 'anonymous' else None
+    body = cache_get(cache_key) if cache_key else None
+    if body is None:
+        with get_db() as conn:
+            if sort == 'hot':
+                rows, epoch = fetch_hot_page(conn, user_id, cursor, limit + 1)
+            else:
+                rows = conn.execute(FEED_QUERY.format(cond="f.post_id < ?", order="DESC"),
+                                    (cursor[0] if cursor else 2 ** 63 - 1, user_id, limit + 1)).fetchall()
+        posts = [{
+            "id": r['id'],
+            "title": r['title'],
+            "date": r['date'],
+            "text": (r['text'] or '')[:FEED_PREVIEW_CHARS],
+            "likes": r['likes'] or 0,
+            "blacklist_count": r['blacklist_count'] or 0,
+            "comment_count": r['comment_count'] or 0,
+            "first_media": r['first_media'],
+            "thumbnail": r['thumbnail'],
+        } for r in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = hot_cursor(rows[limit - 1], epoch) if sort == 'hot' else encode_cursor(rows[limit - 1]['id'])
+        body = json.dumps({"posts": posts, "next_cursor": next_cursor}, ensure_ascii=False, separators=(',', ':'))
+        if cache_key:
+            page_cache.set(cache_key, body)
+    
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.md5(body.encode()).hexdigest())
+    # 内容随新帖、点赞变化，每次都向服务器验证，未变化时只返回 304
+    response.cache_control.no_cache = True
+    if user_id == 'anonymous':
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    return response.make_conditional(request)
+
+def fetch_comments(conn, post_id, before=None, limit=COMMENT_PAGE_SIZE):
+    """按 id 倒序取帖子的一页评论
+    
+    Args:
+        conn: 数据库连接
+        post_id: 帖子 ID
+        before: 只取 id 小于该值的评论，None 表示从最新一条开始
+        limit: 每页条数
+    
+    Returns:
+        tuple: (评论行列表, 下一页游标，没有更多时为 None)
+    """
+    rows = conn.execute("SELECT id, content, date FROM comments WHERE post_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                        (post_id, 2 ** 63 - 1 if before is None else before, limit + 1)).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['id']) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+@app.route('/api/comments/<int:post_id>')
+def api_comments(post_id):
+    """帖子评论的 JSON 分页接口（详情页"加载更多"使用）
+    
+    参数 cursor 为上一页返回的 next_cursor，省略时从最新一条开始；格式错误或评论 ID 超出 64 位整数范围时返回 400。
+    """
+    token = request.args.get('cursor', '')
+    limit = min(max(request.args.get('limit', COMMENT_PAGE_SIZE, type=int), 1), 50)
+    cursor = decode_cursor(token) if token else [None]
+    # decode_cursor 已排除超出 64 位范围的整数；bool 是 int 的子类，这里单独排除
+    if cursor is None or (token and type(cursor[0]) is not int):
+        return jsonify({"status":"error", "message":"无效的游标"}), 400
+    
+    # 评论不区分用户，统一缓存；发表、删除评论时随 post:<id> 命名空间失效
+    cache_key = (f"post:{post_id}", 'comments', token, limit)
+    body = cache_get(cache_key)
+    if body is None:
+        with get_db() as conn:
+            rows, next_cursor = fetch_comments(conn, post_id, cursor[0], limit)
+        body = json.dumps({"comments": [dict(r) for r in rows], "next_cursor": next_cursor},
+                          ensure_ascii=False, separators=(',', ':'))
+        page_cache.set(cache_key, body)
+    
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.md5(body.encode()).hexdigest())
+    response.cache_control.no_cache = True
+    response.cache_control.public = True
+    return response.make_conditional(request)
 
 @app.route('/post/<int:post_id>')
 def detail(post_id):
@@ -386,24 +2899,36 @@ def detail(post_id):
     admin_key = request.args.get('admin_key', '')
     is_admin = (admin_key == ADMIN_KEY)
     
+    cache_key = (f"post:{post_id}", 'detail') if (user_id == 'anonymous' and not admin_key) else None
+    if cache_key:
+        cached = cache_get(cache_key)
+        if cached is not None:
+            return cached
+    
     with get_db() as conn:
         post = conn.execute("SELECT * FROM posts WHERE id=?", (post_id,)).fetchone()
         if not post: return "404", 404
         # 获取相册所有媒体
-        all_media = []
-        if post['media_group_id']:
-            rows = conn.execute("SELECT first_media FROM posts WHERE media_group_id=? AND is_approved=1 ORDER BY id ASC", (post['media_group_id'],)).fetchall()
-            all_media = [r['first_media'] for r in rows]
-        else:
-            all_media = [post['first_media']]
+        all_media = cache_get((f"post:{post_id}", 'media'))
+        if all_media is None:
+            rows = conn.execute("SELECT media FROM post_media WHERE post_id=? ORDER BY position", (post_id,)).fetchall()
+            all_media = [r['media'] for r in rows] or [post['first_media']]
+            page_cache.set((f"post:{post_id}", 'media'), all_media, ttl=3600)
             
-        comments = conn.execute("SELECT * FROM comments WHERE post_id=? ORDER BY id DESC", (post_id,)).fetchall()
+        # 只渲染第一页评论，其余由 /api/comments 按需加载
+        comments, comments_cursor = fetch_comments(conn, post_id)
         
         # 检查是否已收藏
         is_favorited = conn.execute("SELECT 1 FROM user_favorites WHERE user_id=? AND post_id=?", (user_id, post_id)).fetchone() is not None
         
-    return render_template('detail.html', post=post, all_media=all_media, comments=comments, 
-                         is_favorited=is_favorited, user_id=user_id, is_admin=is_admin)
+    # 加上本进程中尚未写回的点赞
+    post = dict(post)
+    post['likes'] = (post['likes'] or 0) + get_pending_likes(post_id)
+    html_page = render_template('detail.html', post=post, all_media=all_media, comments=comments, 
+                                comments_cursor=comments_cursor, is_favorited=is_favorited, user_id=user_id, is_admin=is_admin)
+    if cache_key:
+        page_cache.set(cache_key, html_page)
+    return html_page
 
 @app.route('/api/like/<int:post_id>', methods=['POST'])
 def like(post_id):
@@ -412,8 +2937,7 @@ def like(post_id):
     if not check_rate_limit(f'like_{user_id}', max_requests=10, window_seconds=60):
         return jsonify({"status":"error", "message":"操作过于频繁，请稍后再试"}), 429
     
-    with get_db() as conn: 
-        conn.execute("UPDATE posts SET likes=likes+1 WHERE id=?", (post_id,))
+    record_like(post_id)
     return jsonify({"status":"ok"})
 
 @app.route('/api/comment/<int:post_id>', methods=['POST'])
@@ -428,35 +2952,56 @@ def comment(post_id):
     # XSS protection: escape HTML content
     if content:
         content = html.escape(content)
+        date = datetime.now().strftime("%m-%d %H:%M")
         with get_db() as conn: 
-            conn.execute("INSERT INTO comments (post_id, content, date, user_id) VALUES (?,?,?,?)", 
-                        (post_id, content, datetime.now().strftime("%m-%d %H:%M"), user_id))
+            cur = conn.execute("INSERT INTO comments (post_id, content, date, user_id) VALUES (?,?,?,?)", 
+                        (post_id, content, date, user_id))
+            conn.execute("UPDATE posts SET comment_count=comment_count+1 WHERE id=?", (post_id,))
+            bump_hot_score(conn, post_id, 'comment')
+        invalidate_cache('feed', f"post:{post_id}", *(['user'] if user_id == 'anonymous' else []))
+        # 返回新评论，详情页直接插入列表而不必整页刷新
+        return jsonify({"status":"ok", "comment": {"id": cur.lastrowid, "content": content, "date": date}})
     return jsonify({"status":"ok"})
 
 @app.route('/api/blacklist/<int:post_id>', methods=['POST'])
 def blacklist_user(post_id):
     user_id = request.json.get('user_id', 'anonymous')
+    # Rate limiting: 10 blacklists per minute per user
+    if not check_rate_limit(f'blacklist_{user_id}', max_requests=10, window_seconds=60):
+        return jsonify({"status":"error", "message":"操作过于频繁，请稍后再试"}), 429
     with get_db() as conn:
         # Check if user already blacklisted this post
         existing = conn.execute("SELECT 1 FROM user_blacklist WHERE user_id=? AND post_id=?", (user_id, post_id)).fetchone()
         if not existing:
             conn.execute("INSERT INTO user_blacklist (user_id, post_id, date) VALUES (?,?,?)", (user_id, post_id, datetime.now().strftime("%Y-%m-%d")))
             conn.execute("UPDATE posts SET blacklist_count=blacklist_count+1 WHERE id=?", (post_id,))
+            bump_hot_score(conn, post_id, 'blacklist')
+    # 匿名用户的拉黑会改变匿名首页的内容
+    if user_id == 'anonymous' and not existing:
+        invalidate_cache('feed')
     return jsonify({"status":"ok"})
 
 @app.route('/api/favorite/<int:post_id>', methods=['POST', 'DELETE'])
 def toggle_favorite(post_id):
     user_id = request.json.get('user_id', 'anonymous')
+    # Rate limiting: 30 favorite toggles per minute per user
+    if not check_rate_limit(f'favorite_{user_id}', max_requests=30, window_seconds=60):
+        return jsonify({"status":"error", "message":"操作过于频繁，请稍后再试"}), 429
+    result = {"status":"ok"}
     with get_db() as conn:
         existing = conn.execute("SELECT 1 FROM user_favorites WHERE user_id=? AND post_id=?", (user_id, post_id)).fetchone()
         if request.method == 'POST' and not existing:
             conn.execute("INSERT INTO user_favorites (user_id, post_id, date) VALUES (?,?,?)", 
                         (user_id, post_id, datetime.now().strftime("%Y-%m-%d")))
-            return jsonify({"status":"ok", "favorited":True})
+            bump_hot_score(conn, post_id, 'favorite')
+            result["favorited"] = True
         elif request.method == 'DELETE' and existing:
             conn.execute("DELETE FROM user_favorites WHERE user_id=? AND post_id=?", (user_id, post_id))
-            return jsonify({"status":"ok", "favorited":False})
-    return jsonify({"status":"ok"})
+            bump_hot_score(conn, post_id, 'favorite', -1)
+            result["favorited"] = False
+    if user_id == 'anonymous' and 'favorited' in result:
+        invalidate_cache('user')
+    return jsonify(result)
 
 @app.route('/api/favorites')
 def get_favorites():
@@ -472,21 +3017,32 @@ def get_favorites():
 @app.route('/favorites')
 def favorites_page():
     user_id = request.args.get('user_id', 'anonymous')
+    cache_key = ('user', 'favorites') if user_id == 'anonymous' else None
+    if cache_key:
+        cached = cache_get(cache_key)
+        if cached is not None:
+            return cached
+    notice = get_notice()
     with get_db() as conn:
-        notice = conn.execute("SELECT value FROM settings WHERE key='notice'").fetchone()
-        # Get favorites with grouping similar to index
         posts = conn.execute("""
             SELECT p.* FROM posts p 
             JOIN user_favorites f ON p.id = f.post_id 
             WHERE f.user_id = ? 
-            GROUP BY COALESCE(p.media_group_id, p.id)
             ORDER BY f.date DESC
         """, (user_id,)).fetchall()
-    return render_template('favorites.html', posts=posts, notice=notice['value'] if notice else "", user_id=user_id)
+    html_page = render_template('favorites.html', posts=posts, notice=notice, user_id=user_id)
+    if cache_key:
+        page_cache.set(cache_key, html_page)
+    return html_page
 
 @app.route('/profile')
 def profile():
     user_id = request.args.get('user_id', 'anonymous')
+    cache_key = ('user', 'profile') if user_id == 'anonymous' else None
+    if cache_key:
+        cached = cache_get(cache_key)
+        if cached is not None:
+            return cached
     with get_db() as conn:
         # 获取用户收藏
         favorites = conn.execute("""
@@ -503,7 +3059,10 @@ def profile():
             WHERE c.user_id = ? ORDER BY c.id DESC LIMIT 10
         """, (user_id,)).fetchall()
         
-    return render_template('profile.html', favorites=favorites, comments=comments, user_id=user_id)
+    html_page = render_template('profile.html', favorites=favorites, comments=comments, user_id=user_id)
+    if cache_key:
+        page_cache.set(cache_key, html_page)
+    return html_page
 
 @app.route('/api/admin/description/<int:post_id>', methods=['POST'])
 def update_description(post_id):
@@ -513,6 +3072,7 @@ def update_description(post_id):
     description = request.json.get('description', '')
     with get_db() as conn:
         conn.execute("UPDATE posts SET custom_description=? WHERE id=?", (description, post_id))
+    invalidate_cache('feed', f"post:{post_id}")
     return jsonify({"status":"ok"})
 
 @app.route('/api/admin/post/<int:post_id>', methods=['DELETE'])
@@ -521,11 +3081,12 @@ def delete_post(post_id):
     if admin_key != ADMIN_KEY:
         return jsonify({"status":"error", "message":"权限不足"}), 403
     with get_db() as conn:
-        # 删除帖子及相关数据（评论、收藏、拉黑记录）
+        # 删除帖子及相关数据（评论、收藏、拉黑记录），comment_count 随帖子一起删除
         conn.execute("DELETE FROM comments WHERE post_id=?", (post_id,))
         conn.execute("DELETE FROM user_favorites WHERE post_id=?", (post_id,))
         conn.execute("DELETE FROM user_blacklist WHERE post_id=?", (post_id,))
         conn.execute("DELETE FROM posts WHERE id=?", (post_id,))
+    invalidate_cache('feed', 'user', f"post:{post_id}")
     return jsonify({"status":"ok"})
 
 @app.route('/api/admin/comment/<int:comment_id>', methods=['DELETE'])
@@ -534,9 +3095,69 @@ def admin_delete_comment(comment_id):
     if admin_key != ADMIN_KEY:
         return jsonify({"status":"error", "message":"权限不足"}), 403
     with get_db() as conn:
-        conn.execute("DELETE FROM comments WHERE id=?", (comment_id,))
+        row = conn.execute("SELECT post_id FROM comments WHERE id=?", (comment_id,)).fetchone()
+        # 以实际删除的行数为准，并发重复删除时不会多减
+        if row and conn.execute("DELETE FROM comments WHERE id=?", (comment_id,)).rowcount:
+            conn.execute("UPDATE posts SET comment_count=MAX(comment_count-1, 0) WHERE id=?", (row['post_id'],))
+            bump_hot_score(conn, row['post_id'], 'comment', -1)
+    if row:
+        invalidate_cache('feed', f"post:{row['post_id']}", 'user')
     return jsonify({"status":"ok"})
 
+@app.route('/api/admin/stats')
+def admin_stats():
+    if request.args.get('admin_key', '') != ADMIN_KEY:
+        return jsonify({"status":"error", "message":"权限不足"}), 403
+    with _db_stats_lock:
+        db = dict(db_stats)
+    with _likes_lock:
+        likes = dict(like_stats, pending=sum(_pending_likes.values()))
+    with _download_stats_lock:
+        downloads = dict(download_stats)
+    return jsonify({"db": db, "likes": likes, "cache": page_cache.snapshot(), "downloads": downloads,
+                    "queue": get_ingest_status()['counts'], "outbox": get_outbox_counts()})
+
+@app.route('/api/admin/queue')
+def admin_queue_status():
+    if request.args.get('admin_key', '') != ADMIN_KEY:
+        return jsonify({"status":"error", "message":"权限不足"}), 403
+    return jsonify(get_ingest_status())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 抓取端点：?admin_key= 或 Authorization: Bearer <ADMIN_KEY>"""
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else request.args.get('admin_key', '')
+    if token != ADMIN_KEY:
+        return jsonify({"status":"error", "message":"权限不足"}), 403
+    with _db_stats_lock:
+        db = dict(db_stats)
+    with _likes_lock:
+        likes = dict(like_stats, pending=sum(_pending_likes.values()))
+    with _download_stats_lock:
+        downloads = dict(download_stats)
+    cache = page_cache.snapshot()
+    # 已有的运行统计以 gauge 形式附加在直方图之后
+    gauges = [
+        ('db_connections', db['connections']),
+        ('db_busy_waits', db['busy_waits']),
+        ('db_busy_wait_seconds', db['busy_wait_seconds']),
+        ('db_busy_timeouts', db['busy_timeouts']),
+        ('likes_buffered', likes['buffered']),
+        ('likes_flushed', likes['flushed']),
+        ('likes_flush_errors', likes['flush_errors']),
+        ('likes_pending', likes['pending']),
+        ('media_downloads', downloads['files']),
+        ('media_downloads_reused', downloads['reused']),
+        ('media_downloads_too_large', downloads['too_large']),
+        ('media_download_errors', downloads['errors']),
+    ] + [(f"page_cache_{k}", v) for k, v in cache.items()]
+    lines = [f"# TYPE {name} gauge\n{name} {value:g}" for name, value in gauges]
+    lines += ["# TYPE ingest_queue_jobs gauge"] + [f'ingest_queue_jobs{{status="{k}"}} {v}' for k, v in get_ingest_status()['counts'].items()]
+    lines += ["# TYPE outbox_messages gauge"] + [f'outbox_messages{{status="{k}"}} {v}' for k, v in get_outbox_counts().items()]
+    body = metrics.render() + '\n'.join(lines) + '\n'
+    return app.response_class(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
     # 自动设置 Webhook
     if BASE_URL and BOT_TOKEN:
@@ -0,0 +1,80 @@
+"""媒体下载基准：每次新建连接 + 8KB 分块（旧路径）对比连接池 + 大分块下载器
+
+下载请求打到本地桩服务（tg_stub.py），统计 MB/s 与 files/s；reuse 轮次重复已入库的
+file_unique_id，衡量免 getFile、免下载的命中路径。
+
+用法:
+    python benchmarks/bench_download.py --files 40 --size 2097152 --threads 4
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import requests
+
+from tg_stub import StubHandler, start_stub
+
+stub, stub_url = start_stub()
+os.environ['TELEGRAM_API_URL'] = stub_url
+
+from common import load_app
+
+app = load_app()
+
+def legacy_download(media_obj, ext):
+    """旧实现：每个文件单独 requests.get，8KB 分块写入"""
+    file_info = app.bot.get_file(media_obj.file_id)
+    file_url = f"{app.TELEGRAM_API_URL}/file/bot{app.BOT_TOKEN}/{file_info.file_path}"
+    save_path = os.path.join(app.UPLOAD_DIR, f"{media_obj.file_id}{ext}")
+    r = requests.get(file_url, stream=True, timeout=30)
+    with open(save_path, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=8192):
+            f.write(chunk)
+    os.remove(save_path)  # 防止下一轮命中 file_id 快速路径
+
+def make_message(size, n):
+    file_id = f"{size}-{n}"
+    photo = SimpleNamespace(file_id=file_id, file_unique_id=f"u{file_id}", file_size=size)
+    return SimpleNamespace(photo=[photo], video=None)
+
+def run(mode, messages, threads):
+    StubHandler.stats.update(api_calls=0, file_requests=0)
+    if mode == 'legacy':
+        task = lambda p: legacy_download(p.photo[-1], '.jpg')
+    else:
+        task = lambda p: app.download_media(p)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(task, messages))
+    elapsed = time.perf_counter() - started
+    if mode != 'legacy':
+        assert all(r[0] for r in results), "download failed"
+    total_bytes = sum(p.photo[-1].file_size for p in messages)
+    return {"mode": mode, "files": len(messages), "seconds": round(elapsed, 3),
+            "mb_per_sec": round(total_bytes / elapsed / 1e6, 1), "files_per_sec": round(len(messages) / elapsed, 1),
+            "get_file_calls": StubHandler.stats['api_calls'], "file_requests": StubHandler.stats['file_requests']}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=40)
+    parser.add_argument('--size', type=int, default=2 * 1024 * 1024, help='单个文件字节数')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--json', action='store_true', help='输出 JSON')
+    args = parser.parse_args()
+
+    app.DOWNLOAD_MAX_BYTES = max(app.DOWNLOAD_MAX_BYTES, args.size)
+    messages = [make_message(args.size, n) for n in range(args.files)]
+    results = [run('legacy', messages, args.threads), run('pooled', messages, args.threads),
+               run('reuse', messages, args.threads)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            print(f"{r['mode']:>7}: {r['mb_per_sec']:>8.1f} MB/s  {r['files_per_sec']:>8.1f} files/s  "
+                  f"(getFile {r['get_file_calls']}, downloads {r['file_requests']}, {r['seconds']}s)")
+
+if __name__ == '__main__':
+    main()
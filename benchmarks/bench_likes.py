@@ -0,0 +1,98 @@
+"""点赞写入基准：逐次 UPDATE（旧路径）对比写回缓冲
+
+多个进程 × 多个线程持续通过 test_client 调用 POST /api/like/<id> 若干秒，统计每秒点赞数，
+并校验最终写入数据库的总数。两种模式走同样的路由（含每用户速率限制检查），区别只在路由中调用的
+record_like：direct 模式替换为旧的逐次 UPDATE。每个请求使用新的 user_id，不会被速率限制拦截。
+
+用法:
+    python benchmarks/bench_likes.py --procs 4 --threads 4 --duration 5
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from common import load_app
+
+app = load_app()
+
+def direct_like(post_id):
+    """旧实现：每次点击新建连接并单独提交一个事务"""
+    conn = sqlite3.connect(app.DB_PATH, timeout=30)
+    with conn:
+        conn.execute("UPDATE posts SET likes=likes+1 WHERE id=?", (post_id,))
+    conn.close()
+
+def run_process(mode, threads, duration, post_ids, result_queue):
+    app._workers_pid = os.getpid()  # 不启动入库、发送队列等后台线程，只保留下面需要的写回线程
+    if mode == 'direct':
+        app.record_like = direct_like
+    else:
+        threading.Thread(target=app.like_flusher, daemon=True).start()
+    counts = [0] * threads
+    errors = [0] * threads
+    deadline = time.monotonic() + duration
+
+    def worker(i):
+        rnd = random.Random(i)
+        client = app.app.test_client()
+        n = 0
+        while time.monotonic() < deadline:
+            n += 1
+            r = client.post(f'/api/like/{rnd.choice(post_ids)}', json={'user_id': f'bench-{os.getpid()}-{i}-{n}'})
+            if r.status_code == 200:
+                counts[i] += 1
+            else:
+                errors[i] += 1
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool: t.start()
+    for t in pool: t.join()
+    if mode == 'buffered':
+        app.flush_likes()
+    result_queue.put((sum(counts), sum(errors)))
+
+def run(mode, procs, threads, duration, post_ids):
+    with app.get_db() as conn:
+        conn.execute("UPDATE posts SET likes=0")
+    queue = mp.Queue()
+    started = time.monotonic()
+    workers = [mp.Process(target=run_process, args=(mode, threads, duration, post_ids, queue)) for _ in range(procs)]
+    for p in workers: p.start()
+    totals = [queue.get() for _ in workers]
+    total, errors = sum(t for t, _ in totals), sum(e for _, e in totals)
+    for p in workers: p.join()
+    elapsed = time.monotonic() - started
+    with app.get_db() as conn:
+        stored = conn.execute("SELECT SUM(likes) FROM posts").fetchone()[0]
+    return {"mode": mode, "likes": total, "errors": errors, "stored": stored, "seconds": round(elapsed, 2),
+            "likes_per_sec": round(total / elapsed, 1), "consistent": stored == total}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--procs', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--posts', type=int, default=10, help='被点赞的帖子数（越少越接近热门帖子场景）')
+    parser.add_argument('--json', action='store_true', help='输出 JSON')
+    args = parser.parse_args()
+
+    with app.get_db() as conn:
+        conn.executemany("INSERT INTO posts (msg_id, text, is_approved) VALUES (?, ?, 1)",
+                         [(i, f"bench {i}") for i in range(args.posts)])
+        post_ids = [r['id'] for r in conn.execute("SELECT id FROM posts")]
+
+    results = [run(mode, args.procs, args.threads, args.duration, post_ids) for mode in ('direct', 'buffered')]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            print(f"{r['mode']:>8}: {r['likes_per_sec']:>10.1f} likes/s  ({r['likes']} likes, {r['errors']} errors, stored {r['stored']}, {r['seconds']}s)")
+
+if __name__ == '__main__':
+    mp.set_start_method('fork')
+    main()
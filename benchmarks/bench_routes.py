@@ -0,0 +1,259 @@
+"""路由压测：首页（含搜索、深分页）、详情页、feed 接口、点赞、评论与 webhook
+
+在临时目录中生成合成数据（帖子、相册、评论、收藏、拉黑），Telegram API 指向本地桩服务，
+可完全离线运行。每个路由依次压测，输出 p50/p95/p99 延迟与 req/s；--output 写入 JSON，
+--compare 与之前保存的结果逐项对比，便于在提交之间做 diff。
+
+用法:
+    python benchmarks/bench_routes.py --posts 5000 --requests 500 --concurrency 4
+    python benchmarks/bench_routes.py --output before.json
+    python benchmarks/bench_routes.py --compare before.json
+    python benchmarks/bench_routes.py --server gunicorn --workers 4   # 需要安装 gunicorn
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from tg_stub import start_stub
+
+START_DIR = os.getcwd()
+stub, stub_url = start_stub()
+os.environ['TELEGRAM_API_URL'] = stub_url
+
+from common import ROOT, load_app
+
+app = load_app()
+
+WORDS = ['情报', '频道', '视频', '相册', '更新', '公告', 'matrix', 'hub', 'telegram', 'python', '测试', '数据']
+
+def seed(args):
+    """生成合成数据，返回压测时使用的帖子 ID 等信息"""
+    rnd = random.Random(42)
+    post_rows, media_rows = [], []
+    msg_id = itertools.count(1)
+    for i in range(args.posts):
+        is_album = rnd.random() < args.album_ratio
+        count = rnd.randint(2, 6) if is_album else 1
+        ids = [next(msg_id) for _ in range(count)]
+        text = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 20)))
+        post_rows.append((ids[0], text, '官方', f"2026-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}",
+                          f"album{i}" if is_album else None, f"/uploads/seed{ids[0]}.jpg", rnd.randint(0, 500)))
+        media_rows.append(ids)
+    with app.get_db() as conn:
+        conn.executemany("INSERT INTO posts (msg_id, text, title, date, media_group_id, first_media, likes, is_approved) VALUES (?,?,?,?,?,?,?,1)",
+                         post_rows)
+        id_by_msg = {r['msg_id']: r['id'] for r in conn.execute("SELECT id, msg_id FROM posts")}
+        conn.executemany("INSERT INTO post_media (post_id, position, msg_id, media) VALUES (?,?,?,?)",
+                         [(id_by_msg[ids[0]], pos, m, f"/uploads/seed{m}.jpg") for ids in media_rows for pos, m in enumerate(ids)])
+        post_ids = list(id_by_msg.values())
+        conn.executemany("INSERT INTO comments (post_id, content, date, user_id) VALUES (?,?,?,?)",
+                         [(rnd.choice(post_ids), f"comment {i}", "01-01 00:00", f"user{rnd.randint(0, args.users)}")
+                          for i in range(args.comments)])
+        conn.executemany("INSERT OR IGNORE INTO user_favorites (user_id, post_id, date) VALUES (?,?,?)",
+                         [(f"user{rnd.randint(0, args.users)}", rnd.choice(post_ids), "2026-01-01") for _ in range(args.favorites)])
+        conn.executemany("INSERT OR IGNORE INTO user_blacklist (user_id, post_id, date) VALUES (?,?,?)",
+                         [(f"user{rnd.randint(0, args.users)}", rnd.choice(post_ids), "2026-01-01") for _ in range(args.blacklist)])
+        # 直接插入的点赞不经过热度累加，按点赞数给出热度分
+        conn.execute("UPDATE hot_rank SET score = (SELECT likes FROM posts WHERE posts.id = hot_rank.post_id)")
+        rows, epoch = app.fetch_hot_page(conn, 'anonymous', None, 1, len(post_ids) // 10)
+    return {"post_ids": post_ids, "next_msg_id": next(msg_id) + 1000000, "hot_cursor": app.hot_cursor(rows[0], epoch)}
+
+def build_routes(data, args):
+    """每个路由对应一个生成请求的函数：rnd -> (method, path, json_body)"""
+    post_ids = data['post_ids']
+    msg_ids = itertools.count(data['next_msg_id'])
+    deep_page = max(len(post_ids) // 20 // 2, 2)
+    deep_cursor = sorted(post_ids)[len(post_ids) // 10]
+
+    def user(rnd):
+        return f"user{rnd.randint(0, args.users)}"
+
+    def webhook(rnd):
+        n = next(msg_ids)
+        update = {'update_id': n, 'channel_post': {
+            'message_id': n, 'date': int(time.time()), 'chat': {'id': -100, 'type': 'channel'}, 'caption': 'bench',
+            'photo': [{'file_id': f"2048-{n}", 'file_unique_id': f"u{n}", 'width': 10, 'height': 10, 'file_size': 2048}]}}
+        return 'POST', '/webhook', update
+
+    return {
+        'index_anonymous': lambda rnd: ('GET', '/', None),
+        'index_user': lambda rnd: ('GET', f"/?user_id={user(rnd)}", None),
+        'index_deep_offset': lambda rnd: ('GET', f"/?page={deep_page}&user_id={user(rnd)}", None),
+        'index_deep_cursor': lambda rnd: ('GET', f"/?before={deep_cursor}&user_id={user(rnd)}", None),
+        'search_fts': lambda rnd: ('GET', f"/?q={rnd.choice(['telegram', 'python', 'matrix'])}&user_id={user(rnd)}", None),
+        'search_like': lambda rnd: ('GET', f"/?q={rnd.choice(['情报', '视频', '公告'])}&user_id={user(rnd)}", None),
+        'detail': lambda rnd: ('GET', f"/post/{rnd.choice(post_ids)}?user_id={user(rnd)}", None),
+        'api_feed': lambda rnd: ('GET', f"/api/feed?user_id={user(rnd)}", None),
+        'index_hot': lambda rnd: ('GET', f"/?sort=hot&user_id={user(rnd)}", None),
+        'index_hot_deep_cursor': lambda rnd: ('GET', f"/?sort=hot&page=2&cursor={data['hot_cursor']}&user_id={user(rnd)}", None),
+        'api_feed_hot': lambda rnd: ('GET', f"/api/feed?sort=hot&user_id={user(rnd)}", None),
+        # 点赞 / 评论每次使用新的用户 ID，避免触发速率限制
+        'like': lambda rnd: ('POST', f"/api/like/{rnd.choice(post_ids)}", {'user_id': f"bench{rnd.getrandbits(48)}"}),
+        'comment': lambda rnd: ('POST', f"/api/comment/{rnd.choice(post_ids)}", {'content': 'bench comment', 'user_id': f"bench{rnd.getrandbits(48)}"}),
+        'webhook': webhook,
+    }
+
+class TestClientDriver:
+    """进程内 Flask test client（每个线程一个 client）"""
+    def __init__(self):
+        self.local = threading.local()
+
+    def request(self, method, path, body):
+        client = getattr(self.local, 'client', None) or app.app.test_client()
+        self.local.client = client
+        response = client.open(path, method=method, json=body)
+        return response.status_code
+
+class HttpDriver:
+    """通过 HTTP 访问本地 gunicorn（每个线程一个 keep-alive Session）"""
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.local = threading.local()
+
+    def request(self, method, path, body):
+        session = getattr(self.local, 'session', None) or requests.Session()
+        self.local.session = session
+        return session.request(method, self.base_url + path, json=body, timeout=30).status_code
+
+def start_gunicorn(workers, port=8765):
+    """在数据所在的工作目录启动 gunicorn，返回进程对象和 base URL"""
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app', '--pythonpath', ROOT, '-w', str(workers),
+                             '--threads', '4', '-b', f"127.0.0.1:{port}", '--log-level', 'warning'],
+                            cwd=os.getcwd(), env=os.environ.copy())
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(base_url + '/api/feed', timeout=1)
+            return proc, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+def run_route(driver, make_request, total, concurrency, seed_value):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker(i):
+        nonlocal errors
+        rnd = random.Random(seed_value * 1000 + i)
+        local, local_errors = [], 0
+        while next(counter) < total:
+            method, path, body = make_request(rnd)
+            start = time.perf_counter()
+            try:
+                status = driver.request(method, path, body)
+            except Exception:
+                status = 0
+            local.append(time.perf_counter() - start)
+            if status >= 400 or status == 0:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3)
+    return {"requests": len(latencies), "errors": errors, "seconds": round(elapsed, 3),
+            "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else 0.0,
+            "p50_ms": ms(percentile(latencies, 50)), "p95_ms": ms(percentile(latencies, 95)),
+            "p99_ms": ms(percentile(latencies, 99))}
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def print_report(result, baseline=None):
+    header = f"{'route':<20}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}"
+    print(header + ("   Δreq/s   Δp95" if baseline else ""))
+    for name, r in result['routes'].items():
+        line = f"{name:<20}{r['rps']:>10.1f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['errors']:>8}"
+        base = (baseline or {}).get('routes', {}).get(name)
+        if base:
+            delta = lambda new, old: f"{(new - old) / old * 100:+.0f}%" if old else "n/a"
+            line += f"{delta(r['rps'], base['rps']):>9}{delta(r['p95_ms'], base['p95_ms']):>7}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--album-ratio', type=float, default=0.2, help='相册帖子占比')
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--favorites', type=int, default=5000)
+    parser.add_argument('--blacklist', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500, help='合成用户数（收藏、拉黑、评论的归属）')
+    parser.add_argument('--requests', type=int, default=500, help='每个路由的请求数')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--routes', help='只压测指定路由，逗号分隔')
+    parser.add_argument('--server', choices=['client', 'gunicorn'], default='client',
+                        help='client: 进程内 Flask test client；gunicorn: 启动本地 gunicorn 走真实 HTTP')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker 数')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    parser.add_argument('--compare', help='与之前保存的 JSON 结果对比')
+    parser.add_argument('--json', action='store_true', help='输出 JSON')
+    args = parser.parse_args()
+
+    data = seed(args)
+    routes = build_routes(data, args)
+    if args.routes:
+        routes = {k: v for k, v in routes.items() if k in args.routes.split(',')}
+
+    proc = None
+    if args.server == 'gunicorn':
+        proc, base_url = start_gunicorn(args.workers)
+        driver = HttpDriver(base_url)
+    else:
+        driver = TestClientDriver()
+    try:
+        results = {name: run_route(driver, make, args.requests, args.concurrency, i)
+                   for i, (name, make) in enumerate(routes.items())}
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    result = {
+        "meta": {"revision": git_revision(), "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                 "args": {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'json')}},
+        "routes": results,
+    }
+    if args.output:
+        with open(args.output if os.path.isabs(args.output) else os.path.join(START_DIR, args.output), 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    baseline = None
+    if args.compare:
+        with open(args.compare if os.path.isabs(args.compare) else os.path.join(START_DIR, args.compare)) as f:
+            baseline = json.load(f)
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    else:
+        print_report(result, baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""worker 冷启动基准：每次新开一个 Python 进程导入 app 并处理第一个请求
+
+gunicorn 不加 --preload 时每个 worker 都会完整导入一次 app，这里逐次启动子进程测量：
+- import：导入 app 的耗时（建表 / 迁移、模块级初始化、第三方库导入）
+- first_request：导入后处理第一个 GET / 的耗时
+- wall：子进程从启动到退出的总耗时（含解释器启动）
+fresh 场景每次使用空的数据目录（首次部署），warm 场景复用已初始化的数据库（日常重启 / 扩容）。
+--baseline 把指定 git 版本导出到临时目录，用同样的方式测量，对比改动前后。
+
+用法:
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --runs 10 --baseline HEAD~1
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import ROOT
+
+HEAVY_MODULES = ('cv2', 'numpy', 'telebot', 'requests')
+
+CHILD = r'''
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/')
+done = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "first_request_ms": (done - imported) * 1000,
+                  "modules": [m for m in sys.argv[2].split(',') if m in sys.modules]}))
+'''
+
+def export_revision(rev):
+    """把 git 版本 rev 的代码导出到临时目录
+
+    Returns:
+        str: 导出目录
+    """
+    target = tempfile.mkdtemp(prefix='tbwy-bench-rev-')
+    archive = subprocess.run(['git', '-C', ROOT, 'archive', rev], check=True, capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', target], input=archive, check=True)
+    return target
+
+def boot(code_dir, workdir):
+    """在 workdir 中启动一个子进程导入 code_dir 下的 app，返回测量结果"""
+    env = dict(os.environ, TELEGRAM_TOKEN='0:bench', MY_CHAT_ID='0', ADMIN_KEY='bench')
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', CHILD, code_dir, ','.join(HEAVY_MODULES)],
+                          cwd=workdir, env=env, capture_output=True, text=True, timeout=120)
+    wall = (time.perf_counter() - started) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(f"worker failed to start:\n{proc.stderr}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['wall_ms'] = wall
+    return result
+
+def measure(name, code_dir, runs):
+    """分别测量 fresh / warm 两个场景"""
+    results = []
+    for scenario in ('fresh', 'warm'):
+        if scenario == 'warm':
+            workdir = tempfile.mkdtemp(prefix='tbwy-bench-')
+            boot(code_dir, workdir)  # 预先完成建表 / 迁移
+        samples = []
+        for _ in range(runs):
+            if scenario == 'fresh':
+                workdir = tempfile.mkdtemp(prefix='tbwy-bench-')
+            samples.append(boot(code_dir, workdir))
+        results.append({
+            "variant": name, "scenario": scenario, "runs": runs,
+            **{f"{key}_p50": round(statistics.median(s[f"{key}_ms"] for s in samples), 1)
+               for key in ('import', 'first_request', 'wall')},
+            "modules": samples[-1]['modules'],
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='每个场景启动的次数')
+    parser.add_argument('--baseline', help='对比的 git 版本，例如 HEAD~1')
+    parser.add_argument('--json', action='store_true', help='输出 JSON')
+    args = parser.parse_args()
+
+    results = []
+    if args.baseline:
+        results += measure(args.baseline, export_revision(args.baseline), args.runs)
+    results += measure('working tree', ROOT, args.runs)
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        return
+    print(f"{'variant':<14} {'scenario':<6} {'import':>9} {'1st req':>9} {'wall':>9}  heavy modules loaded")
+    for r in results:
+        print(f"{r['variant']:<14} {r['scenario']:<6} {r['import_p50']:>7.1f}ms {r['first_request_p50']:>7.1f}ms "
+              f"{r['wall_p50']:>7.1f}ms  {', '.join(r['modules']) or '-'}")
+
+if __name__ == '__main__':
+    main()
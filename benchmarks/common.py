@@ -0,0 +1,28 @@
+"""基准测试公共工具
+
+在临时目录中加载 app（data/ 目录随之创建在临时目录下），不会触碰真实数据库。
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_app(workdir=None):
+    """切换到工作目录后导入 app 模块
+
+    Args:
+        workdir: 数据目录的父目录，默认新建临时目录
+
+    Returns:
+        module: app 模块
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='tbwy-bench-')
+    os.environ.setdefault('TELEGRAM_TOKEN', '0:bench')
+    os.environ.setdefault('MY_CHAT_ID', '0')
+    os.environ.setdefault('ADMIN_KEY', 'bench')
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app
+    return app
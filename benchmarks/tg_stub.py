@@ -0,0 +1,94 @@
+"""本地 Telegram Bot API 桩服务
+
+只实现基准测试需要的接口，配合 TELEGRAM_API_URL 环境变量使用：
+
+- /bot<token>/getFile?file_id=<size>-<n>  返回 file_path=files/<size>-<n>
+- /file/bot<token>/files/<size>-<n>       返回 <size> 字节的内容，<n> 不同内容也不同
+- /bot<token>/send*、forward*、copy*、edit* 返回一条最简 Message
+- 其他 /bot<token>/<method>               返回 {"ok": true, "result": true}
+
+用法（单独运行）:
+    python benchmarks/tg_stub.py --port 8081
+"""
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+_BLOB = os.urandom(4 * 1024 * 1024)
+_message_ids = itertools.count(1)
+
+def file_content(file_id):
+    """按 file_id 生成确定的文件内容：8 字节序号 + 循环填充的随机数据"""
+    size, n = (int(x) for x in file_id.split('-'))
+    body = n.to_bytes(8, 'big') + _BLOB[:max(size - 8, 0)]
+    while len(body) < size:
+        body += _BLOB[:size - len(body)]
+    return body[:size]
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持 keep-alive，才能体现连接复用的效果
+    disable_nagle_algorithm = True
+    stats = {'api_calls': 0, 'file_requests': 0}
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts[0] == 'file' and len(parts) >= 3:
+            StubHandler.stats['file_requests'] += 1
+            try:
+                body = file_content(parts[-1])
+            except ValueError:
+                return self._send(404, b'{"ok":false}')
+            return self._send(200, body, 'application/octet-stream')
+        if parts[0].startswith('bot') and len(parts) == 2:
+            StubHandler.stats['api_calls'] += 1
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if parts[1] == 'getFile':
+                file_id = params.get('file_id', '0-0')
+                result = {'file_id': file_id, 'file_unique_id': f"u{file_id}",
+                          'file_size': int(file_id.split('-')[0]), 'file_path': f"files/{file_id}"}
+            elif parts[1].startswith(('send', 'forward', 'copy', 'edit')):
+                # 发送 / 转发 / 编辑类方法返回一条最简 Message
+                result = {'message_id': next(_message_ids), 'date': int(time.time()),
+                          'chat': {'id': int(params.get('chat_id', 0) or 0), 'type': 'private'},
+                          'text': params.get('text', '')}
+            else:
+                result = True
+            return self._send(200, json.dumps({'ok': True, 'result': result}).encode())
+        self._send(404, b'{"ok":false}')
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+def start_stub(port=0):
+    """在后台线程启动桩服务
+
+    Returns:
+        tuple: (server, base_url)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+    server, base_url = start_stub(args.port)
+    print(f"Telegram stub listening on {base_url}")
+    threading.Event().wait()